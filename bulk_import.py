@@ -0,0 +1,78 @@
+import sys
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils import TCPHandler
+from codec import COMPACT_FIRST
+from sharding import ProductShards
+
+
+def read_batches(path: str, batch_size: int):
+    """
+    Yields the items in a JSON lines file, batch_size at a time, so
+    the file is never read in all at once.
+
+    :param path: One item per line, with its quantity and seller.
+                 'status' and 'buyer' default to 'For Sale' and None.
+    """
+    batch = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            item.setdefault('status', 'For Sale')
+            item.setdefault('buyer', None)
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def bulk_import(path: str, batch_size: int = 1000, in_flight: int = 4) -> dict:
+    """
+    Seeds the product database with the items in a file, sending one
+    sell_items request per batch straight to the shards holding each
+    seller. Several batches are sent at once so round trips overlap,
+    but only that many are read ahead of the database.
+
+    :param path: JSON lines file, see read_batches.
+    :param in_flight: Most batches waiting on the database at once.
+    :returns: How many listings and units were added, and the errors.
+    """
+    products = ProductShards(TCPHandler(codecs=COMPACT_FIRST))
+    totals = {'listings': 0, 'units': 0, 'errors': []}
+
+    def tally(resp):
+        listed = [ids for ids in resp.get('ids', []) if ids]
+        totals['listings'] += len(listed)
+        totals['units'] += sum(len(ids) for ids in listed)
+        if 'Error' in resp['status']:
+            totals['errors'].append(resp['status'])
+
+    pending = deque()
+    with ThreadPoolExecutor(in_flight) as executor:
+        for batch in read_batches(path, batch_size):
+            if len(pending) == in_flight:
+                tally(pending.popleft().result())
+            pending.append(executor.submit(
+                products.request, {'route': 'sell_items', 'data': {'items': batch}}))
+        while pending:
+            tally(pending.popleft().result())
+    return totals
+
+
+if __name__ == "__main__":
+    # python bulk_import.py items.jsonl [batch_size]
+    path = sys.argv[1]
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    start = time.time()
+    totals = bulk_import(path, batch_size)
+    elapsed = time.time() - start
+    print(f"Imported {totals['listings']} listings ({totals['units']} units) "
+          f"in {elapsed:.1f}s, {totals['listings'] / max(elapsed, 1e-9):.0f} listings/s.")
+    for error in totals['errors']:
+        print(error)
@@ -16,6 +16,8 @@ class BuyerClient:
         self.benchmarker = ResponseTimeBenchmarker()
         self.is_logged_in = False
         self.username = ""
+        # Session token from the server, sent with every request that needs a login
+        self.token = None
         self.cart = []
 
         self.routes = {
@@ -112,6 +114,7 @@ class BuyerClient:
             if 'Success' in resp['status']:
                 self.is_logged_in = True
                 self.username = data['username']
+                self.token = resp['token']
                 print("\nYou are now logged in!")
             else:
                 print("\n", resp['status'])
@@ -119,6 +122,7 @@ class BuyerClient:
     def logout(self):
         self.is_logged_in = False
         self.username = ""
+        self.token = None
         print("\nYou are now logged out.")
 
     def search(self):
@@ -237,10 +241,61 @@ class BuyerClient:
                 pp.pprint(item)
 
     def make_purchase(self):
-        raise NotImplementedError
+        """
+        Buys everything in the cart in one request. Either every
+        item is bought or, if any of them can't be, none are.
+        """
+        if not self.is_logged_in:
+            print("\nYou must log in before making a purchase.")
+        elif not self.cart:
+            print("\nYour cart is empty.")
+        else:
+            try:
+                data = {
+                    'route': 'make_purchase',
+                    'token': self.token,
+                    'data': {'ids': [item['id'] for item in self.cart]}
+                }
+
+                start = time.time()
+                resp = self.handler.sendrecv('buyer_server', data)
+                end = time.time()
+
+                if not self.debug:
+                    self.benchmarker.log_response_time(end-start)
+
+            except:
+                print("\nThere was a problem with the server. Please try again.")
+            else:
+                if 'Error' in resp['status']:
+                    print("\n", resp['status'])
+                    if resp.get('unavailable'):
+                        print("These items can't be bought:", resp['unavailable'])
+                else:
+                    print(f"\nYou bought {len(self.cart)} items.")
+                    self.cart = []
 
     def provide_feedback(self):
-        raise NotImplementedError
+        """
+        Gives the seller of an item you bought a thumbs up or down.
+        """
+        if not self.is_logged_in:
+            print("\nYou must log in before providing feedback.")
+        else:
+            item_id = int(input("\nPlease provide the ID of the item you bought.\n"))
+            vote = 'pos' if input("Thumbs up? (y/n) ").strip().lower() == 'y' else 'neg'
+
+            try:
+                data = {
+                    'route': 'provide_feedback',
+                    'token': self.token,
+                    'data': {'id': item_id, 'vote': vote}
+                }
+                resp = self.handler.sendrecv('buyer_server', data)
+            except:
+                print("\nThere was a problem with the server. Please try again.")
+            else:
+                print("\n", resp['status'])
 
     def get_seller_rating_by_id(self):
         if self.debug:
@@ -277,7 +332,8 @@ class BuyerClient:
         try:
             data = {
                 'route': 'get_purchase_history',
-                'data': {'username': self.username}
+                'token': self.token,
+                'data': {}
             }
 
             start = time.time()
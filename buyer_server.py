@@ -1,11 +1,46 @@
+import os
+import sys
+import uuid
+import multiprocessing
 import socket
 from utils import TCPHandler
+from server_runtime import run_server
+from codec import COMPACT_FIRST
+from session import SessionManager
+from cache import VersionedCache, SingleFlight
+from sharding import ProductShards
+from product_db import ProductDB
 
 class BuyerServer:
 
     def __init__(self):
-        self.handler = TCPHandler()
-        self.n_requests = 0
+        # Downstream calls to the databases ask for a compact codec
+        self.handler = TCPHandler(codecs=COMPACT_FIRST)
+        # Shared with any worker processes forked by serve()
+        self.n_requests = multiprocessing.Value('q', 0)
+        # Issues tokens on login and checks them without a database hop
+        self.sessions = SessionManager('buyer')
+        # Sends product requests to whichever shards they concern
+        self.products = ProductShards(self.handler)
+        # A copy of the catalog kept in memory and up to date from the
+        # product database's change stream, so searches, lookups and
+        # purchase histories don't need a database hop. CATALOG_VIEW
+        # picks its storage engine, or 'off'.
+        view = os.environ.get('CATALOG_VIEW', 'dict')
+        if view != 'off':
+            for shard, name in enumerate(self.products.names):
+                # Never served, so the replica number doesn't matter
+                self.products.views[name] = ProductDB(view, None, shard, 0)
+                # Read by every handler thread while the copy follows
+                self.products.views[name].enable_snapshots()
+            self.products.max_staleness = float(os.environ.get('CATALOG_MAX_STALENESS', 1.0))
+        # Recent database responses, reused until the version of a
+        # database they came from changes
+        self.cache = VersionedCache()
+        # Identical cacheable requests in flight at once share one call
+        self.flights = SingleFlight()
+        # Routes that need a valid session token
+        self.AUTH_ROUTES = ['get_purchase_history', 'make_purchase', 'provide_feedback']
     
     def create_account(self, data: dict) -> dict:
         """
@@ -17,40 +52,40 @@ class BuyerServer:
         """
         try:
             # Make a call to the customer database
-            return self.handler.sendrecv(dest='customer_db', data=data)
+            return self._send('customer_db', data)
         except:
             return {'status': 'Error: Customer database.'}
 
     def login(self, data: dict) -> dict:
+        """
+        Checks the password with the customer database and, if it's
+        right, returns a session token for the other routes.
+        """
+        data['type'] = 'buyer'
         # Make a call to the customer database
-        return self.handler.sendrecv(dest='customer_db', data=data)
+        resp = self._send('customer_db', data)
+        if 'Success' in resp['status']:
+            resp['token'] = self.sessions.issue(data['username'])
+        return resp
 
     def search(self, data: dict) -> dict:
         """
         Returns an item as a search result if either the 
         category matches or at least one of the keywords
-        match.
+        match. The product database does the filtering.
         """
-        # Get all the items from the database
-        db_req = {'route': 'search'}
+        db_req = {
+            'route': 'query',
+            'data': {
+                'category': data['data']['category'],
+                'keywords': data['data']['keywords'],
+                'expand': data['data'].get('expand', True)
+            }
+        }
+        query = db_req['data']
+        key = ('query', query['category'], tuple(sorted(set(query['keywords']))), query['expand'])
         try:
-            all_items = self.handler.sendrecv('product_db', db_req)['data']
-
-            # Filtering criteria
-            category = data['data']['category']
-            keywords = data['data']['keywords']
-
-            # Filter the ones that meet the criteria
-            search_result = []
-            for product in all_items:
-                # Add the item if the category matches
-                if product['category'] == category:
-                    search_result.append(product)
-                    continue
-                
-                # Add item if any keywords match
-                if len(set(product['keywords']) & set(keywords)) > 0:
-                    search_result.append(product)
+            search_result = self._send('product_db', db_req, key)['data']
 
             # Send the response back
             return {'status': 'Success', 'data': search_result}
@@ -59,71 +94,181 @@ class BuyerServer:
 
     def check_if_item_exists(self, data: dict) -> dict:
         """
-        Gets all the products from the database and
-        checks if the specified product ID exists.
+        Looks the specified product ID up in the database.
         """
         try:
-            db_req = {'route': 'search'}
-            all_products = self.handler.sendrecv('product_db', db_req)['data']
+            db_req = {'route': 'get_item', 'data': {'id': data['data']['id']}}
+            db_resp = self._send('product_db', db_req, ('get_item', data['data']['id']))
         except:
             return {'status': 'Error: Database connection.'}
         else:
-            # Look for the product of interest
-            for product in all_products:
-                if product['id'] == data['data']['id']:
-                    resp = {
-                        'status': 'Success: Item found.',
-                        'data': product
-                    }
-                    return resp
-
-            # Item not found
-            return {'status': 'Error: Item not found.'}
+            if 'Error' in db_resp['status']:
+                return {'status': 'Error: Item not found.'}
+
+            resp = {
+                'status': 'Success: Item found.',
+                'data': db_resp['data']
+            }
+            return resp
 
     def get_seller_rating_by_id(self, data: dict) -> dict:
         try:
-            db_req = {'route': 'get_all_sellers'}
-            db_resp = self.handler.sendrecv('customer_db', db_req)
+            # Only the seller's feedback comes back
+            db_req = {'route': 'get_seller_rating_by_id', 'id': data['data']['id']}
+            return self._send('customer_db', db_req, ('rating', data['data']['id']))
         except:
             print("Error connecting server to customer database.")
             return {'status': 'Error: Cannot connect buyer server to customer database.'}
-        else:
-            seller_id = data['data']['id']
-            for seller in db_resp['data']:
-                if seller['id'] == seller_id:
-                    resp = {
-                        'status': db_resp['status'],
-                        'data': {
-                            'pos': seller['feedback']['pos'],
-                            'neg': seller['feedback']['neg']
-                        }
-                        
-                    }
-                    return resp
-
-            return {'status': 'Error: Seller not found.'}
+
+    def make_purchase(self, data: dict) -> dict:
+        """
+        Buys every item in the cart, or none of them, in one request.
+        The checkout is two-phase: both databases first prepare it
+        (the product database reserves the items, the customer
+        database checks the accounts), and only if both agree is it
+        committed on both. Otherwise it's aborted on both.
+        """
+        ids, buyer = data['data']['ids'], data['user']
+        txn = uuid.uuid4().hex
+        prepared, shards = [], None
+
+        try:
+            db_req = {'route': 'prepare_purchase', 'data': {'txn': txn, 'ids': ids, 'buyer': buyer}}
+            product_resp = self._send('product_db', db_req)
+            if 'Error' in product_resp['status']:
+                return product_resp
+            prepared.append('product_db')
+            # The product shards holding the cart, if there are several
+            shards = product_resp.get('shards')
+
+            db_req = {'route': 'prepare_purchase', 'txn': txn, 'buyer': buyer,
+                      'sellers': product_resp['sellers']}
+            customer_resp = self._send('customer_db', db_req)
+            if 'Error' in customer_resp['status']:
+                self._finish_purchase(txn, prepared, 'abort_purchase', shards)
+                return customer_resp
+            prepared.append('customer_db')
+        except:
+            self._finish_purchase(txn, prepared, 'abort_purchase', shards)
+            return {'status': 'Error: Cannot connect buyer server to database.'}
+
+        # Both databases agreed, so the purchase goes through
+        if not self._finish_purchase(txn, prepared, 'commit_purchase', shards, buyer):
+            return {'status': 'Error: Purchase may not have completed.'}
+        return {'status': 'Success: Purchase complete.', 'ids': ids}
+
+    def _finish_purchase(self, txn: str, dbs: list, route: str, shards: list = None,
+                         buyer: str = None) -> bool:
+        """
+        Sends the second phase of a checkout to the databases that
+        prepared it.
+
+        :param shards: The product shards that prepared it, if the
+                       product database is sharded.
+        :param buyer: The buyer, so their later reads see the purchase.
+        :returns: False if any database didn't get it.
+        """
+        ok = True
+        for db in dbs:
+            if db == 'product_db':
+                db_req = {'route': route, 'data': {'txn': txn}}
+                if shards is not None:
+                    db_req['data']['shards'] = shards
+            else:
+                db_req = {'route': route, 'txn': txn}
+            try:
+                if 'Error' in self._send(db, db_req, user=buyer)['status']:
+                    ok = False
+            except:
+                ok = False
+        return ok
+
+    def provide_feedback(self, data: dict) -> dict:
+        """
+        Gives the seller of an item the user bought a thumbs up
+        ('pos') or down ('neg').
+        """
+        item_id = data['data']['id']
+        try:
+            db_resp = self._send('product_db', {'route': 'get_item', 'data': {'id': item_id}},
+                                 user=data['user'])
+            item = db_resp.get('data')
+            if item is None or item['status'] != 'Sold' or item['buyer'] != data['user']:
+                return {'status': 'Error: You can only rate items you bought.'}
+
+            db_req = {'route': 'provide_feedback', 'seller': item['seller'],
+                      'item_id': item_id, 'vote': data['data']['vote']}
+            return self._send('customer_db', db_req)
+        except:
+            return {'status': 'Error: Cannot connect buyer server to database.'}
 
     def get_purchase_history(self, data: dict) -> dict:
         try:
-            db_req = {'route': 'search'}
-            products = self.handler.sendrecv('product_db', db_req)['data']
+            db_req = {
+                'route': 'get_purchase_history',
+                'data': {
+                    'username': data['user'],
+                    'expand': data.get('data', {}).get('expand', True)
+                }
+            }
+            buyers_products = self._send('product_db', db_req, user=data['user'])['data']
         except:
             print("Error connecting buyer server to product database.")
             return {'status': 'Error: Cannot connect buyer server to product database.'}
         else:
-            buyers_products = []
-            for product in products:
-                if product['buyer'] == data['data']['username']:
-                    buyers_products.append(product)
-
             resp = {
                 'status': "Success: Here's your filthy data.",
                 'data': buyers_products
             }
             return resp
 
+    def _send(self, db: str, db_req: dict, key=None, user: str = None) -> dict:
+        """
+        Sends a request to a database and notes the version its
+        response came with. If key is given, a response cached under
+        it is returned instead while it's still current, and requests
+        for the same key made while one is already in flight wait for
+        its response rather than sending their own.
+
+        :param user: The logged in user the request is for, so product
+                     replicas can't answer it with data older than
+                     their own writes. Never given with key.
+        """
+        if key is None:
+            resp, versions = self._request(db, db_req, user)
+            self.cache.observe(versions)
+            return resp
+
+        resp = self.cache.get(key)
+        if resp is not None:
+            return resp
+
+        def fetch():
+            resp, versions = self._request(db, db_req)
+            self.cache.put(key, resp, versions)
+            return resp
+
+        # Only join calls started since the last change we know of,
+        # so a user never gets data older than their own writes
+        return self.flights.do((key, self.cache.current()), fetch)
+
+    def _request(self, db: str, db_req: dict, user: str = None) -> tuple:
+        """
+        :returns: The database's response, and the version of every
+                  database (or product shard) that answered.
+        """
+        if db == 'product_db':
+            resp = self.products.request(db_req, user)
+            return resp, resp.pop('versions')
+        resp = self.handler.sendrecv(db, db_req)
+        return resp, {db: resp.get('version')}
+
+    def get_cache_stats(self, data: dict) -> dict:
+        return {'cache': self.cache.stats(), 'single_flight': self.flights.stats(),
+                'products': self.products.stats()}
+
     def get_request_count(self, data: dict) -> dict:
-        return {'requests': self.n_requests}
+        return {'requests': self.n_requests.value}
 
     def _route_request(self, route: str):
         """
@@ -139,31 +284,42 @@ class BuyerServer:
             return None
 
 
-    def serve(self):
+    def _handle_request(self, data: dict) -> dict:
+        """
+        Figures out what function was called from the header
+        and calls it.
+        """
+        with self.n_requests.get_lock():
+            self.n_requests.value += 1
+        if data['route'] in self.AUTH_ROUTES:
+            username = self.sessions.validate(data.get('token'))
+            if username is None:
+                return {'status': 'Error: Not logged in.'}
+            # The token says who the user is, not the request
+            data['user'] = username
+        route = self._route_request(data['route'])
+        return route(data)
+
+    def serve(self, mode: str = 'asyncio', workers: int = None,
+              backlog: int = 128):
+        """
+        :param mode: 'asyncio', 'serial', 'thread' or 'process'. See
+                     server_runtime.run_server.
+        :param workers: Number of threads or processes for the mode.
+        :param backlog: Connections the OS will queue before we accept them.
+        """
         # Get a listening socket from the TCPHandler
-        seller_socket = self.handler.get_listener('buyer_server')
+        seller_socket = self.handler.get_listener('buyer_server', backlog)
         print("Buyer server waiting for incoming connections.\n")
 
-        # Main accept() loop
-        while True:
-            # Accept a new request from a client
-            new_sock, client_addr = seller_socket.accept()
-            print(f"Accepted connection from {client_addr}.\n")
-            self.n_requests += 1
-            data = self.handler.recv(new_sock)
-
-            # Figure out what function was called from the header and call it
-            route = self._route_request(data['route'])
-            response = route(data)
-
-            # Send the response and check for errors in doing so
-            self.handler.send(new_sock, response)
-
-            # No longer need that connection
-            new_sock.close()
-            print(f"Disconnected from {client_addr}.\n")
+        # Main loop. Connections are kept open between requests.
+        run_server(self.handler, seller_socket, self._handle_request, mode, workers)
 
 
 if __name__ == "__main__":
     server = BuyerServer()
-    server.serve()
\ No newline at end of file
+    # python <server>.py [mode] [workers] [backlog]
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'asyncio'
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    backlog = int(sys.argv[3]) if len(sys.argv) > 3 else 128
+    server.serve(mode, workers, backlog)
\ No newline at end of file
@@ -0,0 +1,140 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class VersionedCache:
+    """
+    LRU cache of database responses. Every database (or product
+    database shard) puts its current version in its responses, and
+    bumps it whenever its data changes. An entry remembers the
+    versions of the databases it came from, and is only used while
+    those are still the newest versions seen from them, so any write
+    we hear about invalidates everything that depended on it. Writes
+    made through other servers are only heard about on our next
+    response from the database, so entries also expire after ttl
+    seconds.
+    """
+
+    def __init__(self, max_entries: int = 4096, ttl: float = 2.0):
+        """
+        :param max_entries: Most responses to keep.
+        :param ttl: Seconds an entry may be used for, at most.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        # Key -> (versions, time stored, response), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Database -> newest version seen from it
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def observe(self, versions: dict) -> None:
+        """
+        Notes the versions a response came with.
+
+        :param versions: Database -> version.
+        """
+        with self._lock:
+            for db, version in versions.items():
+                if version is not None and (db not in self.versions
+                                            or version > self.versions[db]):
+                    self.versions[db] = version
+
+    def current(self) -> tuple:
+        """
+        The newest versions seen, as something hashable.
+        """
+        with self._lock:
+            return tuple(sorted(self.versions.items()))
+
+    def get(self, key):
+        """
+        :returns: The cached response, or None if there isn't a
+                  current one.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None and time.monotonic() - entry[1] < self.ttl
+                    and all(self.versions.get(db) == v for db, v in entry[0].items())):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            return None
+
+    def put(self, key, resp: dict, versions: dict) -> None:
+        """
+        Stores a response under key, at the versions it came with.
+        """
+        self.observe(versions)
+        if not versions or None in versions.values():
+            return
+        with self._lock:
+            self._entries[key] = (versions, time.monotonic(), resp)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'versions': dict(self.versions),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+class SingleFlight:
+    """
+    Coalesces identical requests that are in flight at the same time.
+    The first caller for a key runs the call and every caller that
+    arrives for the same key before it finishes waits for, and gets,
+    the same result. So a burst of identical searches costs the
+    database one request rather than one per client.
+    """
+
+    def __init__(self):
+        # Key -> Future for the call in flight
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, func):
+        """
+        Calls func, unless a call for key is already in flight, in
+        which case its result is returned (or its exception raised)
+        instead.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = Future()
+                leader = True
+                self.calls += 1
+            else:
+                leader = False
+                self.coalesced += 1
+
+        if not leader:
+            return call.result()
+
+        try:
+            call.set_result(func())
+        except BaseException as e:
+            call.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return call.result()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'in_flight': len(self._calls), 'calls': self.calls,
+                    'coalesced': self.coalesced}
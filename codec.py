@@ -0,0 +1,264 @@
+import json
+import struct
+from itertools import chain
+from operator import itemgetter
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def has_records(values: list) -> bool:
+    """
+    True if there is a dictionary anywhere in values.
+    """
+    types = set(map(type, values))
+    if dict in types:
+        return True
+    if list in types:
+        return has_records(list(chain.from_iterable(v for v in values if type(v) is list)))
+    return False
+
+
+def tabulate(obj):
+    """
+    Rewrites lists of dictionaries that all share the same keys
+    (e.g. a page of products) as a Table, so the key names are
+    only written once instead of once per record.
+    """
+    if type(obj) is dict:
+        return {k: tabulate(v) if type(v) in (dict, list) else v for k, v in obj.items()}
+    if type(obj) is list:
+        if len(obj) > 1 and set(map(type, obj)) == {dict}:
+            keys = list(obj[0])
+            if keys and set(map(len, obj)) == {len(keys)}:
+                try:
+                    columns = [list(map(itemgetter(k), obj)) for k in keys]
+                except KeyError:
+                    columns = None
+                if columns is not None:
+                    for i, column in enumerate(columns):
+                        if has_records(column):
+                            columns[i] = [tabulate(v) for v in column]
+                    return Table(keys, columns)
+        if has_records(obj):
+            return [tabulate(v) for v in obj]
+    return obj
+
+
+class Table:
+    """
+    A list of records with one shared schema, stored column by column.
+    """
+
+    def __init__(self, keys: list, columns: list):
+        self.keys = keys
+        self.columns = columns
+
+    def to_dicts(self) -> list:
+        keys = self.keys
+        return [dict(zip(keys, row)) for row in zip(*self.columns)]
+
+
+class JSONCodec:
+    """
+    UTF-8 encoded JSON. Every peer understands it.
+    """
+    name = 'json'
+    marker = 0xFE
+
+    def encode(self, data) -> bytes:
+        return json.dumps(data).encode('utf-8')
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class MsgpackCodec:
+    """
+    MessagePack, with record lists sent as tables. Only available
+    if the msgpack package is installed.
+    """
+    name = 'msgpack'
+    marker = 0xFC
+    TABLE_EXT = 1
+    BIG_INT_EXT = 2
+
+    def _default(self, obj):
+        if isinstance(obj, Table):
+            return msgpack.ExtType(self.TABLE_EXT, self.encode_raw([obj.keys, obj.columns]))
+        if type(obj) is int:
+            return msgpack.ExtType(self.BIG_INT_EXT, str(obj).encode('ascii'))
+        raise TypeError(f"cannot serialize {type(obj)}")
+
+    def _ext_hook(self, code: int, data: bytes):
+        if code == self.TABLE_EXT:
+            keys, columns = self.decode(data)
+            return Table(keys, columns).to_dicts()
+        if code == self.BIG_INT_EXT:
+            return int(data)
+        return msgpack.ExtType(code, data)
+
+    def encode_raw(self, data) -> bytes:
+        return msgpack.packb(data, default=self._default)
+
+    def encode(self, data) -> bytes:
+        return self.encode_raw(tabulate(data))
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, ext_hook=self._ext_hook,
+                               strict_map_key=False)
+
+
+class PackedCodec:
+    """
+    Compact binary encoding built on struct, so it works without any
+    third-party packages. Record lists are sent as tables, and short
+    strings that repeat within a message (statuses, seller names,
+    keywords) are sent once and then referred to by index. Slower
+    than msgpack, so only preferred when msgpack isn't installed.
+
+    Every value starts with a one byte tag:
+        N None, T True, F False, i int64, I big int, d float64,
+        s string, r string reference, l list, m dict, t table
+    """
+    name = 'packed'
+    marker = 0xFD
+
+    U32 = struct.Struct('!I')
+    I64 = struct.Struct('!q')
+    F64 = struct.Struct('!d')
+    # Strings up to this many bytes go in the reference table
+    MAX_REF_LEN = 32
+
+    def encode(self, data) -> bytes:
+        out = bytearray()
+        self._write(out, tabulate(data), {})
+        return bytes(out)
+
+    def _write_str(self, out: bytearray, value: str, refs: dict) -> None:
+        ref = refs.get(value)
+        if ref is not None:
+            out += b'r'
+            out += self.U32.pack(ref)
+            return
+
+        raw = value.encode('utf-8')
+        if len(raw) <= self.MAX_REF_LEN:
+            refs[value] = len(refs)
+        out += b's'
+        out += self.U32.pack(len(raw))
+        out += raw
+
+    def _write(self, out: bytearray, value, refs: dict) -> None:
+        if value is None:
+            out += b'N'
+        elif value is True:
+            out += b'T'
+        elif value is False:
+            out += b'F'
+        elif type(value) is int:
+            if -2**63 <= value < 2**63:
+                out += b'i'
+                out += self.I64.pack(value)
+            else:
+                raw = str(value).encode('ascii')
+                out += b'I'
+                out += self.U32.pack(len(raw))
+                out += raw
+        elif type(value) is float:
+            out += b'd'
+            out += self.F64.pack(value)
+        elif type(value) is str:
+            self._write_str(out, value, refs)
+        elif type(value) in (list, tuple):
+            out += b'l'
+            out += self.U32.pack(len(value))
+            for item in value:
+                self._write(out, item, refs)
+        elif type(value) is dict:
+            out += b'm'
+            out += self.U32.pack(len(value))
+            for k, v in value.items():
+                # JSON turns keys into strings, so do the same
+                self._write_str(out, str(k), refs)
+                self._write(out, v, refs)
+        elif isinstance(value, Table):
+            out += b't'
+            out += self.U32.pack(len(value.keys))
+            for k in value.keys:
+                self._write_str(out, k, refs)
+            for column in value.columns:
+                self._write(out, column, refs)
+        else:
+            raise TypeError(f"cannot serialize {type(value)}")
+
+    def decode(self, payload):
+        value, _ = self._read(memoryview(payload), 0, [])
+        return value
+
+    def _read(self, buf: memoryview, pos: int, refs: list):
+        tag = buf[pos]
+        pos += 1
+
+        if tag == 0x4E:     # N
+            return None, pos
+        if tag == 0x54:     # T
+            return True, pos
+        if tag == 0x46:     # F
+            return False, pos
+        if tag == 0x69:     # i
+            return self.I64.unpack_from(buf, pos)[0], pos + 8
+        if tag == 0x64:     # d
+            return self.F64.unpack_from(buf, pos)[0], pos + 8
+        if tag == 0x72:     # r
+            return refs[self.U32.unpack_from(buf, pos)[0]], pos + 4
+        if tag in (0x73, 0x49):     # s, I
+            n = self.U32.unpack_from(buf, pos)[0]
+            pos += 4
+            value = str(buf[pos:pos + n], 'utf-8')
+            if tag == 0x49:
+                return int(value), pos + n
+            if n <= self.MAX_REF_LEN:
+                refs.append(value)
+            return value, pos + n
+        if tag == 0x6C:     # l
+            n = self.U32.unpack_from(buf, pos)[0]
+            pos += 4
+            items = []
+            for _ in range(n):
+                item, pos = self._read(buf, pos, refs)
+                items.append(item)
+            return items, pos
+        if tag == 0x6D:     # m
+            n = self.U32.unpack_from(buf, pos)[0]
+            pos += 4
+            obj = {}
+            for _ in range(n):
+                k, pos = self._read(buf, pos, refs)
+                obj[k], pos = self._read(buf, pos, refs)
+            return obj, pos
+        if tag == 0x74:     # t
+            n_keys = self.U32.unpack_from(buf, pos)[0]
+            pos += 4
+            keys = []
+            for _ in range(n_keys):
+                k, pos = self._read(buf, pos, refs)
+                keys.append(k)
+            columns = []
+            for _ in range(n_keys):
+                column, pos = self._read(buf, pos, refs)
+                columns.append(column)
+            return Table(keys, columns).to_dicts(), pos
+
+        raise ValueError(f"unknown tag {tag} in packed message.")
+
+
+# Every codec this process can speak, by name and by frame marker
+CODECS = {c.name: c for c in [JSONCodec(), PackedCodec()]}
+if msgpack is not None:
+    CODECS['msgpack'] = MsgpackCodec()
+BY_MARKER = {c.marker: c for c in CODECS.values()}
+# Preference order for connections that carry catalog-sized replies
+COMPACT_FIRST = [n for n in ['msgpack', 'packed', 'json'] if n in CODECS]
@@ -1,11 +1,19 @@
+import sys
+import time
 import socket
+import asyncio
 from utils import TCPHandler
+from server_runtime import AsyncServer
+from passwords import PasswordHasher
 import json
 
 class CustomerDB:
 
-    def __init__(self):
+    def __init__(self, hash_workers: int = None, hash_cost: int = 2**14):
         """
+        :param hash_workers: Threads hashing passwords at once.
+        :param hash_cost: scrypt cost (n) for new passwords.
+
         Sets up data structures used for saving information about
         buyers and sellers. See the example below for the objects
         that hold seller and buyer info.
@@ -26,84 +34,219 @@ class CustomerDB:
         }
         """
         self.handler = TCPHandler()
+        # Sent with every response and bumped on every change, so the
+        # frontends know when what they've cached is out of date
+        self.version = time.time_ns()
         # The 'database' itself
         self.sellers = []
         self.buyers = []
+        # Indexes on both, by account type. Usernames are unique
+        # within an account type.
+        self.by_username = {'seller': {}, 'buyer': {}}
+        self.by_id = {'seller': {}, 'buyer': {}}
+        # Passwords are stored hashed. Hashing happens off the event
+        # loop, so other routes don't wait behind logins.
+        self.hasher = PasswordHasher(hash_workers, n=hash_cost)
+        # Checkouts that have been prepared but not committed, by
+        # transaction ID
+        self.transactions = {}
+        # IDs of the items that have been given feedback
+        self.rated_items = set()
 
-    def create_account(self, data: dict) -> dict:
+    async def create_account(self, data: dict) -> dict:
         if 'username' not in data.keys() or 'password' not in data.keys():
             return {'status': 'Error: Invalid packet supplied to create_account.'}
 
+        if data.get('type') not in self.by_username:
+            return {'status': 'Error: Invalid account type.'}
+        if data['username'] in self.by_username[data['type']]:
+            return {'status': 'Error: Username already taken.'}
+
+        password_hash = await asyncio.wrap_future(self.hasher.hash(data['password']))
+        # Someone may have taken the name while we were hashing
+        if data['username'] in self.by_username[data['type']]:
+            return {'status': 'Error: Username already taken.'}
+
         if data['type'] == 'seller':
             # Add the new user
-            self.sellers.append({
+            user = {
                 'username': data['username'],
-                'password': data['password'],
+                'password_hash': password_hash,
                 'id': len(self.sellers) + 1,
                 'feedback': {'pos': 0, 'neg': 0},
                 'items_sold': 0
-            })
-        elif data['type'] == 'buyer':
-            self.buyers.append({
+            }
+            self.sellers.append(user)
+        else:
+            user = {
                 'username': data['username'],
-                'password': data['password'],
+                'password_hash': password_hash,
                 'id': len(self.buyers) + 1,
                 'items_purchased': 0
-            })
+            }
+            self.buyers.append(user)
+
+        self.by_username[data['type']][user['username']] = user
+        self.by_id[data['type']][user['id']] = user
+        self.version += 1
 
         return {'status': 'Success: Account created.'}
 
-    def login(self, data: dict) -> dict:
+    async def login(self, data: dict) -> dict:
         """
-        Search the database for a user with the provided
-        username and password.
+        Look up the user with the provided username and
+        check their password against the stored hash.
         """
         unm, pwd = data['username'], data['password']
-        users = self.sellers if data['type'] == 'seller' else self.buyers
+        users = self.by_username['seller' if data['type'] == 'seller' else 'buyer']
+
+        user = users.get(unm)
+        if user is not None and await asyncio.wrap_future(
+                self.hasher.verify(pwd, user['password_hash'])):
+            return {'status': 'Success: Logged in successfully.'}
 
-        for user in users:
-            if user['username'] == unm and user['password'] == pwd:
-                return {'status': 'Success: Logged in successfully.'}
-        
         return {'status': 'Error: Incorrect username or password.'}
 
+    def _public(self, user: dict) -> dict:
+        """
+        The account without its password hash, for sending out.
+        """
+        return {k: v for k, v in user.items() if k != 'password_hash'}
+
     def get_seller_rating(self, data: dict) -> dict:
         """
         Return the seller feedback of a the specified user.
         """
         # Find the user we're looking for
-        user_of_interest = None
-        for user in self.sellers:
-            if user['username'] == data['username']:
-                user_of_interest = user
-                break
-        
+        user_of_interest = self.by_username['seller'].get(data['username'])
+
         # Return the packet
         if user_of_interest == None:
             resp = {'status': 'Error: User not found.'}
         else:
             resp = {
                 'status': 'Success',
-                'user': user_of_interest 
+                'user': self._public(user_of_interest)
             }
 
         return resp
 
+    def get_seller_by_id(self, data: dict) -> dict:
+        """
+        Return the seller with the specified ID.
+        """
+        user = self.by_id['seller'].get(data['id'])
+        if user is None:
+            return {'status': 'Error: User not found.'}
+        else:
+            return {'status': 'Success', 'user': self._public(user)}
+
+    def _rating(self, user: dict) -> dict:
+        return {'pos': user['feedback']['pos'], 'neg': user['feedback']['neg']}
+
+    def get_seller_rating_by_id(self, data: dict) -> dict:
+        """
+        Return only the feedback of the seller with the specified ID.
+        """
+        user = self.by_id['seller'].get(data['id'])
+        if user is None:
+            return {'status': 'Error: Seller not found.'}
+        else:
+            return {'status': 'Success', 'data': self._rating(user)}
+
+    def get_seller_ratings(self, data: dict) -> dict:
+        """
+        Batch version of get_seller_rating_by_id. IDs that don't
+        exist are listed under 'missing'.
+        """
+        ratings, missing = [], []
+        for _id in data['ids']:
+            user = self.by_id['seller'].get(_id)
+            if user is None:
+                missing.append(_id)
+            else:
+                ratings.append({'id': _id, **self._rating(user)})
+
+        return {'status': 'Success', 'data': ratings, 'missing': missing}
+
     def get_all_sellers(self, data: dict) -> dict:
         data = {
             'status': 'Success: Here ya go.',
-            'data': self.sellers
+            'data': [self._public(user) for user in self.sellers]
         }
         return data
 
-    def get_num_items_sold(self):
-        raise NotImplementedError
+    def get_hash_metrics(self, data: dict) -> dict:
+        """
+        Queue depth and latency of the password hashing pool.
+        """
+        return {'status': 'Success', 'data': self.hasher.metrics()}
 
-    def provide_feedback(self):
-        raise NotImplementedError
+    def get_num_items_sold(self, data: dict) -> dict:
+        user = self.by_username['seller'].get(data['username'])
+        if user is None:
+            return {'status': 'Error: User not found.'}
+        return {'status': 'Success', 'data': user['items_sold']}
 
-    def get_num_items_bought(self):
-        raise NotImplementedError
+    def get_num_items_bought(self, data: dict) -> dict:
+        user = self.by_username['buyer'].get(data['username'])
+        if user is None:
+            return {'status': 'Error: User not found.'}
+        return {'status': 'Success', 'data': user['items_purchased']}
+
+    def provide_feedback(self, data: dict) -> dict:
+        """
+        Adds a thumbs up ('pos') or down ('neg') to the seller of the
+        item. Each item can only be rated once. The buyer server
+        checks that the item was bought by the user rating it.
+        """
+        seller = self.by_username['seller'].get(data['seller'])
+        if seller is None:
+            return {'status': 'Error: User not found.'}
+        if data['vote'] not in ['pos', 'neg']:
+            return {'status': 'Error: Feedback must be pos or neg.'}
+        if data['item_id'] in self.rated_items:
+            return {'status': 'Error: Item already rated.'}
+
+        self.rated_items.add(data['item_id'])
+        seller['feedback'][data['vote']] += 1
+        self.version += 1
+        return {'status': 'Success: Feedback recorded.'}
+
+    def prepare_purchase(self, data: dict) -> dict:
+        """
+        First phase of a checkout. Checks that the buyer and every
+        seller exist, and holds on to the counts until the commit.
+
+        :param data: 'txn', the 'buyer' and the number of items bought
+                     from each seller under 'sellers'.
+        """
+        if data['buyer'] not in self.by_username['buyer']:
+            return {'status': 'Error: User not found.'}
+        if any(s not in self.by_username['seller'] for s in data['sellers']):
+            return {'status': 'Error: Seller not found.'}
+
+        self.transactions[data['txn']] = data
+        return {'status': 'Success'}
+
+    def commit_purchase(self, data: dict) -> dict:
+        """
+        Second phase of a checkout. Updates the buyer's and sellers'
+        item counts.
+        """
+        txn = self.transactions.pop(data['txn'], None)
+        if txn is None:
+            return {'status': 'Error: Unknown transaction.'}
+
+        self.by_username['buyer'][txn['buyer']]['items_purchased'] += sum(txn['sellers'].values())
+        for seller, n in txn['sellers'].items():
+            self.by_username['seller'][seller]['items_sold'] += n
+        self.version += 1
+        return {'status': 'Success'}
+
+    def abort_purchase(self, data: dict) -> dict:
+        self.transactions.pop(data['txn'], None)
+        return {'status': 'Success'}
 
     def _route_request(self, route: str):
         """
@@ -115,34 +258,59 @@ class CustomerDB:
         else:
             return None
 
-    def serve(self):
-        # Get a listening socket from the TCPHandler
-        customerdb_socket = self.handler.get_listener('customer_db')
-        print("Customer database waiting for incoming connections.\n")
+    def _handle_request(self, data: dict) -> dict:
+        """
+        Figures out what function was called from the header
+        and calls it. Routes that hash passwords are coroutines,
+        which AsyncServer awaits.
+        """
+        route = self._route_request(data['route'])
+        if route:
+            resp = route(data)
+        else:
+            resp = {'status': 'Error: Invalid database route.'}
 
-        # Main accept() loop
-        while True:
-            # Accept a new request from a client
-            new_sock, client_addr = customerdb_socket.accept()
-            print(f"Accepted connection from {client_addr}.")
-            data = self.handler.recv(new_sock)
-
-            # Figure out what function was called from the header and call it
-            route = self._route_request(data['route'])
-            if route:
-                response = route(data)
-            else:
-                response = {'staus': 'Error: Invalid database route.'}
+        if asyncio.iscoroutine(resp):
+            return self._add_version(resp)
+        resp['version'] = self.version
+        return resp
 
-            # Send the response and check for errors in doing so
-            self.handler.send(new_sock, response)
+    async def _add_version(self, coro) -> dict:
+        resp = await coro
+        resp['version'] = self.version
+        return resp
 
-            # No longer need that connection
-            new_sock.close()
-            print(f"Disconnected from {client_addr}.")
+    def _handle_request_serial(self, data: dict) -> dict:
+        """
+        _handle_request for the serial loop, which can't await.
+        """
+        resp = self._handle_request(data)
+        if asyncio.iscoroutine(resp):
+            resp = asyncio.run(resp)
+        return resp
 
+    def serve(self, mode: str = 'asyncio'):
+        """
+        :param mode: 'asyncio' serves all connections concurrently on an
+                     event loop. 'serial' answers one request at a time.
+                     Either way requests are handled one at a time, so
+                     the database is never touched by two at once.
+        """
+        # Get a listening socket from the TCPHandler
+        customerdb_socket = self.handler.get_listener('customer_db')
+        print("Customer database waiting for incoming connections.\n")
+
+        # Main loop. Connections are kept open between requests.
+        if mode == 'asyncio':
+            AsyncServer(self.handler, self._handle_request).run(customerdb_socket)
+        else:
+            self.handler.serve_forever(customerdb_socket, self._handle_request_serial)
 
 
 if __name__ == "__main__":
-    db = CustomerDB()
-    db.serve()
\ No newline at end of file
+    # python customer_db.py [mode] [hash_workers] [hash_cost]
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'asyncio'
+    hash_workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    hash_cost = int(sys.argv[3]) if len(sys.argv) > 3 else 2**14
+    db = CustomerDB(hash_workers, hash_cost)
+    db.serve(mode)
\ No newline at end of file
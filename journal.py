@@ -0,0 +1,246 @@
+import os
+import gc
+import json
+import time
+import zlib
+import pickle
+import struct
+import threading
+
+
+class Journal:
+    """
+    Write-ahead log plus snapshots for a product store, kept in one
+    directory:
+
+        log.<n>        Writes, in order. A new segment is started
+                       every time a snapshot is taken.
+        snapshot.<n>   The store as of the start of log.<n>.
+
+    Writes are applied to the store and appended to the current log
+    segment. They reach the disk in groups: a background thread
+    fsyncs whatever has been written every sync_interval seconds, so
+    a burst of writes shares one fsync and no request waits on one.
+    A crash loses at most the last sync_interval seconds of writes.
+
+    Snapshots are written by a forked child, which gets a frozen
+    copy of the store for free, so the server keeps answering
+    requests while it's pickled. Recovery loads the newest snapshot
+    and replays only the log segments written after it.
+    """
+
+    # Header of every log record: payload length + CRC32 of the payload
+    RECORD_HEADER = struct.Struct('!II')
+
+    def __init__(self, path: str, sync_interval: float = 0.01,
+                 snapshot_every: int = 100000):
+        """
+        :param path: Directory to keep the log and snapshots in.
+                     Created if it doesn't exist.
+        :param sync_interval: Seconds between fsyncs of the log.
+        :param snapshot_every: Number of writes after which a new
+                               snapshot is started.
+        """
+        self.path = path
+        self.sync_interval = sync_interval
+        self.snapshot_every = snapshot_every
+        os.makedirs(path, exist_ok=True)
+
+        self._seq = 0
+        self._file = None
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._writes = 0
+        # pid and sequence number of the snapshot being written, if any
+        self._snapshot_pid = None
+        self._snapshot_seq = None
+
+    def _name(self, kind: str, seq: int) -> str:
+        return os.path.join(self.path, f'{kind}.{seq:08d}')
+
+    def _listing(self, kind: str) -> list:
+        """
+        Sequence numbers of the files of this kind, oldest first.
+        """
+        seqs = []
+        for name in os.listdir(self.path):
+            prefix, _, seq = name.partition('.')
+            if prefix == kind and seq.isdigit():
+                seqs.append(int(seq))
+        return sorted(seqs)
+
+    def _read_segment(self, seq: int):
+        """
+        Yields the records in a log segment. Stops at the first torn
+        or corrupt record, which can only be the tail of a segment
+        that was being written when the process died.
+        """
+        with open(self._name('log', seq), 'rb') as f:
+            data = f.read()
+
+        pos, header = 0, self.RECORD_HEADER
+        while pos + header.size <= len(data):
+            length, crc = header.unpack_from(data, pos)
+            payload = data[pos + header.size:pos + header.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            yield json.loads(payload)
+            pos += header.size + length
+
+    def recover(self, make_store):
+        """
+        Rebuilds the store from the newest snapshot and the log
+        written after it, then starts a new log segment.
+
+        :param make_store: Called to create an empty store if there's
+                           no snapshot yet.
+        :returns: The recovered store.
+        """
+        snapshots = self._listing('snapshot')
+        if snapshots:
+            # Loading creates millions of objects and none of them are
+            # garbage, so keep the collector from scanning them, both
+            # now and on every full collection after
+            gc.disable()
+            try:
+                with open(self._name('snapshot', snapshots[-1]), 'rb') as f:
+                    store = pickle.load(f)
+                gc.freeze()
+            finally:
+                gc.enable()
+            start = snapshots[-1]
+        else:
+            store = make_store()
+            start = 0
+
+        t = time.time()
+        n = 0
+        segments = [seq for seq in self._listing('log') if seq >= start]
+        for seq in segments:
+            for op, args in self._read_segment(seq):
+                getattr(store, op)(*args)
+                n += 1
+        if snapshots or n:
+            print(f"Recovered {len(store)} products ({n} log records replayed "
+                  f"in {time.time() - t:.2f}s).")
+
+        # Never append to a segment that may end in a torn record
+        self._seq = max(segments + [start - 1]) + 1
+        self._file = open(self._name('log', self._seq), 'ab')
+        self._writes = n
+        threading.Thread(target=self._sync_forever, daemon=True).start()
+        return store
+
+    def append(self, op: str, args: list) -> None:
+        """
+        Logs a call to a store method. The record is written right
+        away and fsynced by the background thread.
+        """
+        payload = json.dumps([op, args]).encode('utf-8')
+        record = self.RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            self._file.write(record)
+        self._writes += 1
+        self._dirty.set()
+
+    def _sync_forever(self) -> None:
+        """
+        Group commit. Waits for writes, then flushes and fsyncs every
+        record written since the last fsync at once.
+        """
+        while True:
+            self._dirty.wait()
+            time.sleep(self.sync_interval)
+            self._dirty.clear()
+            with self._lock:
+                self._file.flush()
+                # Our own handle, so the segment can be rotated mid-fsync
+                fd = os.dup(self._file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _rotate(self) -> int:
+        """
+        Closes the current log segment and starts the next one.
+
+        :returns: The new segment's sequence number.
+        """
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._seq += 1
+            self._file = open(self._name('log', self._seq), 'ab')
+        return self._seq
+
+    def _reap_snapshot(self) -> None:
+        """
+        If the snapshot child has exited, deletes the files the new
+        snapshot made redundant.
+        """
+        if self._snapshot_pid is None:
+            return
+        pid, status = os.waitpid(self._snapshot_pid, os.WNOHANG)
+        if pid == 0:
+            return
+
+        seq = self._snapshot_seq
+        self._snapshot_pid = self._snapshot_seq = None
+        if os.waitstatus_to_exitcode(status) != 0:
+            print("Error: Snapshot failed. Keeping the log.")
+            return
+        for kind in ['log', 'snapshot']:
+            for old in self._listing(kind):
+                if old < seq:
+                    os.remove(self._name(kind, old))
+
+    def maybe_snapshot(self, store) -> None:
+        """
+        Starts a background snapshot once snapshot_every writes have
+        been logged since the last one. Must be called between writes,
+        so the snapshot lines up with the start of a log segment.
+        """
+        self._reap_snapshot()
+        if self._writes < self.snapshot_every or self._snapshot_pid is not None:
+            return
+        self.snapshot(store)
+
+    def snapshot(self, store) -> None:
+        """
+        Forks a child that writes the store to snapshot.<n>, where n
+        is the log segment started right before the fork.
+        """
+        seq = self._rotate()
+        self._writes = 0
+
+        pid = os.fork()
+        if pid:
+            self._snapshot_pid, self._snapshot_seq = pid, seq
+            return
+
+        # Child: write to a temporary name so a partial snapshot
+        # is never mistaken for a complete one
+        code = 1
+        try:
+            tmp = self._name('snapshot', seq) + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump(store, f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self._name('snapshot', seq))
+            dir_fd = os.open(self.path, os.O_RDONLY)
+            os.fsync(dir_fd)
+            os.close(dir_fd)
+            code = 0
+        finally:
+            os._exit(code)
+
+    def close(self) -> None:
+        """
+        Flushes and fsyncs the log.
+        """
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
@@ -0,0 +1,114 @@
+import os
+import hmac
+import time
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PasswordHasher:
+    """
+    Hashes and checks passwords with scrypt on a bounded pool of
+    threads. hashlib releases the GIL while it hashes, so the pool
+    runs hashes in parallel and the thread that submitted them (the
+    database's event loop) stays free for other requests.
+
+    Hashes are stored as 'scrypt$n$r$p$salt$hash', so the cost can
+    be raised later without breaking existing accounts.
+    """
+
+    def __init__(self, workers: int = None, n: int = 2**14, r: int = 8, p: int = 1):
+        """
+        :param workers: Hashes computed at once. Defaults to the
+                        number of CPUs. Further requests wait in the
+                        pool's queue.
+        :param n: scrypt CPU/memory cost. Must be a power of 2.
+        :param r: scrypt block size.
+        :param p: scrypt parallelization.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(self.workers)
+        self.n, self.r, self.p = n, r, p
+
+        self._lock = threading.Lock()
+        # Submitted but not started, and started but not finished
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        # Seconds from submission to result, for the most recent hashes
+        self._latencies = deque(maxlen=1000)
+
+    def _scrypt(self, password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+        return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r + 2**20, dklen=32)
+
+    def _hash(self, password: str) -> str:
+        salt = os.urandom(16)
+        digest = self._scrypt(password, salt, self.n, self.r, self.p)
+        return f'scrypt${self.n}${self.r}${self.p}${salt.hex()}${digest.hex()}'
+
+    def _verify(self, password: str, stored: str) -> bool:
+        _, n, r, p, salt, digest = stored.split('$')
+        actual = self._scrypt(password, bytes.fromhex(salt), int(n), int(r), int(p))
+        return hmac.compare_digest(actual.hex(), digest)
+
+    def _run(self, func, *args):
+        """
+        Calls func in the pool, keeping the metrics up to date.
+
+        :returns: A concurrent.futures.Future for the result.
+        """
+        submitted = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+
+        def task():
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+                    self._latencies.append(time.perf_counter() - submitted)
+
+        return self.executor.submit(task)
+
+    def hash(self, password: str):
+        """
+        :returns: A future for the password's stored form.
+        """
+        return self._run(self._hash, password)
+
+    def verify(self, password: str, stored: str):
+        """
+        :returns: A future for whether the password matches the
+                  stored hash.
+        """
+        return self._run(self._verify, password, stored)
+
+    def metrics(self) -> dict:
+        """
+        Queue depth and latency (seconds, submission to result) of
+        the hashing pool.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            metrics = {
+                'workers': self.workers,
+                'queued': self._queued,
+                'running': self._running,
+                'completed': self._completed
+            }
+
+        if latencies:
+            metrics['latency'] = {
+                'mean': sum(latencies) / len(latencies),
+                'p50': latencies[len(latencies) // 2],
+                'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+                'max': latencies[-1]
+            }
+        return metrics
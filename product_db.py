@@ -1,12 +1,34 @@
+import os
+import sys
+import time
 import socket
-import copy
+import threading
 from utils import TCPHandler
+from codec import COMPACT_FIRST
+from product_store import ENGINES
+from server_runtime import AsyncServer
+from journal import Journal
+from snapshot import Snapshots
+from sharding import ID_BLOCK, READ_ROUTES, shard_name, replica_name, add_shard_addresses
 
 
 class ProductDB:
 
-    def __init__(self):
+    def __init__(self, storage: str = 'dict', data_dir: str = None, shard: int = 0,
+                 replica: int = None):
         """
+        :param storage: Storage engine, 'dict', 'columnar' or 'mmap'.
+        :param data_dir: Directory to keep the write-ahead log and
+                         snapshots in. If None, products only live
+                         in memory and are lost on restart. The mmap
+                         engine keeps its segment files here instead.
+        :param shard: Which shard of the catalog this is, if it's
+                      split across several databases. See sharding.py.
+        :param replica: If given, this is a read-only copy of the shard,
+                        with this number, that follows the shard's
+                        primary through its change stream. Replicas
+                        keep the products in memory.
+
         Products are dictionaries with the following format:
         {
             'name': 'Toothbrush',
@@ -21,7 +43,117 @@ class ProductDB:
         }
         """
         self.handler = TCPHandler()
-        self.products = []
+        self.shard = shard
+        self.replica = replica
+        self.storage = storage
+        # The store numbers its units from 1. Shard k adds this to
+        # give its own block of ids, so ids are unique across shards.
+        self.id_offset = shard * ID_BLOCK
+        # Sent with every response and bumped on every change, so the
+        # frontends know when what they've cached is out of date.
+        # Starts at the boot time so it keeps increasing across restarts.
+        self.version = time.time_ns()
+        # Items held for checkouts that are still in progress, and the
+        # checkouts themselves, by transaction ID. Only kept in memory,
+        # so a restart aborts them.
+        self.reserved = {}
+        self.transactions = {}
+        # Seconds a checkout may hold its items before it's aborted
+        self.RESERVATION_TIMEOUT = 30
+        # Every recent change as (version, method, args), oldest first,
+        # for replicas to catch up from. Versions go up by one per change.
+        self.changes = []
+        self.CHANGE_LOG_SIZE = 100000
+        # Most changes sent to a replica at once
+        self.MAX_CHANGES = 10000
+        # Listings with nothing left for sale are moved to the store's
+        # archive in the background, at most this many at a time
+        self.COMPACT_BATCH = 1000
+        self.COMPACT_INTERVAL = 1.0
+        # Replicas: set once the first copy from the primary has
+        # arrived, and held while changes from it are applied
+        self.synced = False
+        self.lock = threading.Lock()
+        # Replicas: when the primary last had no changes we hadn't
+        # got, by time.monotonic(), and the process following it
+        self.synced_at = float('-inf')
+        self._following = None
+        # Set by enable_snapshots(), for serving reads alongside writes.
+        # Each read request pins its snapshot in its thread's _reading.
+        self.snapshots = None
+        self._reading = threading.local()
+        # Where the products are kept. See product_store.ENGINES.
+        self.journal = None
+        if replica is not None:
+            if storage == 'mmap' or data_dir is not None:
+                raise ValueError("replicas keep their products in memory.")
+            self.store = ENGINES[storage]()
+        elif storage == 'mmap':
+            if data_dir is None:
+                raise ValueError("the mmap engine needs a data directory.")
+            # Already on disk, so there's nothing to journal
+            self.store = ENGINES[storage](data_dir)
+        elif data_dir is None:
+            self.store = ENGINES[storage]()
+        else:
+            self.journal = Journal(data_dir)
+            self.store = self.journal.recover(ENGINES[storage])
+            if type(self.store) is not ENGINES[storage]:
+                raise ValueError(f"{data_dir} holds a snapshot of another storage engine.")
+
+    @property
+    def store(self):
+        """
+        The store routes read from. With snapshots, that's the one the
+        current read request pinned, or else the latest.
+        """
+        if self.snapshots is None:
+            return self._store
+        pinned = getattr(self._reading, 'store', None)
+        return pinned if pinned is not None else self.snapshots.latest()
+
+    @store.setter
+    def store(self, store) -> None:
+        self._store = store
+        if self.snapshots is not None:
+            self.snapshots = Snapshots(store)
+
+    def enable_snapshots(self) -> None:
+        """
+        Lets read routes run in any number of threads at once, and
+        alongside writes, each on a consistent snapshot of the store.
+        See snapshot.Snapshots. Costs a second copy of the store, so
+        it's only turned on where reads run concurrently, and not for
+        the mmap engine, which can't be copied.
+        """
+        if self.storage != 'mmap' and self.snapshots is None:
+            self.snapshots = Snapshots(self._store)
+
+    def _apply(self, op: str, args) -> None:
+        """
+        Calls a store method that changes it, publishing the result
+        if there are snapshots.
+        """
+        if self.snapshots is not None:
+            return self.snapshots.write(op, *args)
+        return getattr(self._store, op)(*args)
+
+    def _write(self, op: str, *args):
+        """
+        Calls a store method that changes the products and, if the
+        database is durable, logs the call. Calls that fail aren't
+        logged, so replaying the log can't fail either. Every change
+        to the store goes through here.
+        """
+        result = self._apply(op, args)
+        self.version += 1
+        self.changes.append((self.version, op, list(args)))
+        if len(self.changes) > 2 * self.CHANGE_LOG_SIZE:
+            del self.changes[:self.CHANGE_LOG_SIZE]
+        if self.journal is not None:
+            self.journal.append(op, list(args))
+            self.journal.maybe_snapshot(self.store)
+        return result
 
     def sell_item(self, data: dict) -> dict:
         """
@@ -34,24 +166,62 @@ class ProductDB:
         item = data['data']
         quantity = item['quantity']
         del item['quantity']
-        
-        item_ids = []
-        for _ in range(quantity):
-            item_copy = copy.deepcopy(item)
-            _id = len(self.products) + 1
-            item_copy['id'] = _id
-            item_ids.append(_id)
-            self.products.append(item_copy)
+        if len(self.store) + quantity > ID_BLOCK:
+            return {'status': 'Error: The product database is full.'}
+
+        # One copy of the item is stored however many are listed
+        try:
+            item_ids = self._write('add_listing', item, quantity)
+        except ValueError as e:
+            return {'status': f'Error: {e}'}
 
         return {'status': 'Sucess: Items listed.', 'ids': item_ids}
 
+    def sell_items(self, data: dict) -> dict:
+        """
+        Adds many listings in one request, each one as sell_item would.
+
+        :param data: 'items', a list of items, each with its quantity
+                     and seller.
+        :returns: 'ids', the new ids of each listing in the order
+                  given. A listing that couldn't be added gets no ids,
+                  and the status is the first error.
+        """
+        items = data['data']['items']
+        if len(self.store) + sum(item['quantity'] for item in items) > ID_BLOCK:
+            return {'status': 'Error: The product database is full.'}
+
+        status, ids = 'Success: Items listed.', []
+        for item in items:
+            item = dict(item)
+            quantity = item.pop('quantity')
+            try:
+                ids.append(self._write('add_listing', item, quantity))
+            except ValueError as e:
+                if 'Error' not in status:
+                    status = f'Error: {e}'
+                ids.append([])
+        return {'status': status, 'ids': ids}
+
     def remove_item(self, data: dict) -> dict:
+        """
+        Marks items for sale as removed. If a seller is given, only
+        their own items are removed.
+        """
         ids = data['data']['ids']
+        seller = data['data'].get('seller')
         items_removed = 0
-        
-        for item in self.products:
-            if item['id'] in ids:
-                item['status'] = 'Removed'
+
+        for _id in ids:
+            # Items being bought can't be pulled out from under the buyer
+            if _id in self.reserved:
+                continue
+            item = self.store.get(_id)
+            if item is None or item['status'] != 'For Sale':
+                continue
+            if seller is not None and item['seller'] != seller:
+                continue
+            if self._write('set_status', _id, 'Removed'):
                 items_removed += 1
 
         if items_removed == len(ids):
@@ -59,16 +229,39 @@ class ProductDB:
         else:
             return {'status': 'Error: Some items may not have been removed.'}
 
-    def list_items(self, data: dict) -> dict:
+    def get_item(self, data: dict) -> dict:
+        """
+        Looks up a single item by its ID.
+        """
+        item = self.store.get(data['data']['id'])
+        if item is None:
+            return {'status': 'Error: Item not found.'}
+        else:
+            return {'status': 'Success', 'data': item}
+
+    def get_items(self, data: dict) -> dict:
         """
-        Returns items for sale by the seller specified.
+        Looks up a batch of items by ID. IDs that don't exist
+        are listed under 'missing'.
         """
-        sellers_items = []
-        seller = data['data']['username']
+        items, missing = [], []
+        for _id in data['data']['ids']:
+            item = self.store.get(_id)
+            if item is None:
+                missing.append(_id)
+            else:
+                items.append(item)
+
+        return {'status': 'Success', 'data': items, 'missing': missing}
 
-        for item in self.products:
-            if item['seller'] == seller and item['status'] == 'For Sale':
-                sellers_items.append(item)
+    def list_items(self, data: dict) -> dict:
+        """
+        Returns items for sale by the seller specified. If 'expand'
+        is False, identical units are collapsed into one record with
+        a 'quantity' and their 'ids' as [first, last] ranges.
+        """
+        expand = data['data'].get('expand', True)
+        sellers_items = self.store.for_seller(data['data']['username'], 'For Sale', expand=expand)
 
         resp = {
             'status': 'Success',
@@ -77,12 +270,241 @@ class ProductDB:
 
         return resp
 
+    def get_purchase_history(self, data: dict) -> dict:
+        """
+        Returns every item bought by the buyer specified, collapsed
+        like list_items if 'expand' is False.
+        """
+        expand = data['data'].get('expand', True)
+        items = self.store.for_buyer(data['data']['username'], expand=expand)
+        return {'status': 'Success', 'data': items}
+
     def search(self, data: dict) -> dict:
         """
-        Simply return the products. Processing happens
-        on the buyer server.
+        Simply return the products, apart from archived ones.
+        Processing happens on the buyer server.
         """
-        return {'data': self.products}
+        expand = data.get('data', {}).get('expand', True)
+        return {'data': self.store.all(expand=expand)}
+
+    def query(self, data: dict) -> dict:
+        """
+        Returns the items for sale that are either in the given
+        category or share at least one keyword with the query,
+        optionally limited to a price range. Only the matching
+        items are sent back, collapsed like list_items if 'expand'
+        is False.
+        """
+        query = data['data']
+        items = self.store.query(query['category'], query['keywords'],
+                                 query.get('min_price'), query.get('max_price'),
+                                 expand=query.get('expand', True))
+        return {'status': 'Success', 'data': items}
+
+    def prepare_purchase(self, data: dict) -> dict:
+        """
+        First phase of a checkout. Reserves every item in the cart if
+        all of them are for sale, or none of them otherwise.
+
+        :returns: How many of the items each seller is selling, or the
+                  IDs that can't be bought under 'unavailable'.
+        """
+        txn, ids = data['data']['txn'], data['data']['ids']
+        self._expire_reservations()
+
+        sellers, unavailable, seen = {}, [], set()
+        for _id in ids:
+            item = self.store.get(_id)
+            if (item is None or item['status'] != 'For Sale' or _id in self.reserved
+                    or _id in seen):
+                unavailable.append(_id)
+            else:
+                sellers[item['seller']] = sellers.get(item['seller'], 0) + 1
+            seen.add(_id)
+
+        if unavailable or not ids:
+            return {'status': 'Error: Some items are not for sale.', 'unavailable': unavailable}
+
+        for _id in ids:
+            self.reserved[_id] = txn
+        self.transactions[txn] = {
+            'ids': ids,
+            'buyer': data['data']['buyer'],
+            'expires': time.time() + self.RESERVATION_TIMEOUT
+        }
+        return {'status': 'Success', 'sellers': sellers}
+
+    def commit_purchase(self, data: dict) -> dict:
+        """
+        Second phase of a checkout. Marks the reserved items as sold.
+        """
+        txn = self.transactions.pop(data['data']['txn'], None)
+        if txn is None:
+            return {'status': 'Error: Unknown transaction.'}
+
+        for _id in txn['ids']:
+            del self.reserved[_id]
+            self._write('set_status', _id, 'Sold', txn['buyer'])
+        return {'status': 'Success'}
+
+    def abort_purchase(self, data: dict) -> dict:
+        """
+        Releases a checkout's items without selling them.
+        """
+        txn = self.transactions.pop(data['data']['txn'], None)
+        if txn is not None:
+            for _id in txn['ids']:
+                del self.reserved[_id]
+        return {'status': 'Success'}
+
+    def compact(self, data: dict = None) -> dict:
+        """
+        Moves up to COMPACT_BATCH listings with no units left for
+        sale into the store's archive. Lookups by id and purchase
+        histories still find them, but searches no longer scan them.
+
+        :returns: How many listings were archived.
+        """
+        lids = self.store.dead_listings(self.COMPACT_BATCH)
+        if lids:
+            self._write('archive', lids)
+        return {'status': 'Success', 'archived': len(lids)}
+
+    def _compact(self) -> None:
+        """
+        Keeps compacting a batch at a time, so a write never waits on
+        more than one batch. Runs forever on its own thread.
+        """
+        while True:
+            with self.lock:
+                archived = self.compact()['archived']
+            if archived < self.COMPACT_BATCH:
+                time.sleep(self.COMPACT_INTERVAL)
+
+    def changes_since(self, data: dict) -> dict:
+        """
+        The change stream replicas follow. Returns the changes made
+        after version 'since', oldest first, as [method, args] store
+        calls, and 'to', the version they bring a replica up to. If
+        those changes aren't all kept any more, or since is from
+        before a restart, 'reset' is True and the changes instead
+        rebuild the whole store from empty. 'more' is True if there
+        are more changes to fetch.
+        """
+        since = data['data']['since']
+        first = self.changes[0][0] if self.changes else self.version + 1
+        if first - 1 <= since <= self.version:
+            start = since - first + 1
+            changes = [[op, args] for _, op, args in self.changes[start:start + self.MAX_CHANGES]]
+            to, reset = since + len(changes), False
+        else:
+            changes = [[op, args] for op, args in self.store.ops()]
+            to, reset = self.version, True
+
+        return {'status': 'Success', 'changes': changes, 'to': to, 'reset': reset,
+                'more': to < self.version}
+
+    def _follow(self, interval: float = 0.02) -> None:
+        """
+        Keeps a replica up to date with its primary. Runs forever on
+        its own thread.
+
+        :param interval: Seconds to wait between polls once caught up.
+        """
+        handler = TCPHandler(codecs=COMPACT_FIRST)
+        primary = shard_name(self.shard)
+        add_shard_addresses(handler, self.shard + 1)
+        since = -1
+        while True:
+            sent = time.monotonic()
+            try:
+                resp = handler.sendrecv(primary, {'route': 'changes_since',
+                                                  'data': {'since': since}})
+            except (ConnectionError, OSError):
+                time.sleep(1)
+                continue
+
+            if resp['reset']:
+                # Built off to the side so reads aren't held up
+                store = ENGINES[self.storage]()
+                for op, args in resp['changes']:
+                    getattr(store, op)(*args)
+                with self.lock:
+                    self.store = store
+                    self.version = resp['to']
+                    self.synced = True
+            elif self.snapshots is not None:
+                for op, args in resp['changes']:
+                    self._apply(op, args)
+                self.version = resp['to']
+            else:
+                with self.lock:
+                    for op, args in resp['changes']:
+                        self._apply(op, args)
+                    self.version = resp['to']
+            since = resp['to']
+            if not resp['more']:
+                self.synced_at = sent
+                time.sleep(interval)
+
+    def follow(self) -> None:
+        """
+        Starts keeping a replica up to date in the background, unless
+        this process already is. Threads don't survive a fork, so a
+        forked worker starts its own.
+        """
+        if self._following != os.getpid():
+            self._following = os.getpid()
+            threading.Thread(target=self._follow, daemon=True).start()
+
+    def _expire_reservations(self) -> None:
+        """
+        Aborts checkouts whose coordinator never finished them.
+        """
+        now = time.time()
+        for txn in [t for t, info in self.transactions.items() if info['expires'] < now]:
+            self.abort_purchase({'data': {'txn': txn}})
+
+    def _to_local(self, data: dict) -> None:
+        """
+        Turns the ids in a request into the store's own.
+        """
+        req = data.get('data')
+        if not isinstance(req, dict):
+            return
+        if type(req.get('id')) is int:
+            req['id'] -= self.id_offset
+        if isinstance(req.get('ids'), list):
+            req['ids'] = [_id - self.id_offset if type(_id) is int else _id
+                          for _id in req['ids']]
+
+    def _to_global(self, resp: dict) -> None:
+        """
+        Turns the store's ids in a response into this shard's block.
+        """
+        offset = self.id_offset
+
+        def shift(_id):
+            # sell_items returns a list of ids per listing
+            if isinstance(_id, list):
+                return [i + offset for i in _id]
+            return _id + offset if type(_id) is int else _id
+
+        for key in ('ids', 'missing', 'unavailable'):
+            if key in resp:
+                resp[key] = [shift(_id) for _id in resp[key]]
+
+        for key in ('data', 'items'):
+            records = resp.get(key)
+            if isinstance(records, dict):
+                records = [records]
+            if not isinstance(records, list):
+                continue
+            for record in records:
+                record['id'] += offset
+                if 'ids' in record:
+                    record['ids'] = [[first + offset, last + offset]
+                                     for first, last in record['ids']]
 
     def _route_request(self, route: str):
         """
@@ -94,33 +516,90 @@ class ProductDB:
         else:
             return None
 
-    def serve(self):
-        # Get a listening socket from the TCPHandler
-        productdb_socket = self.handler.get_listener('product_db')
-        print("Product database waiting for incoming connections.\n")
+    def _handle_request(self, data: dict) -> dict:
+        """
+        Figures out what function was called from the header
+        and calls it.
+        """
+        if self.replica is not None:
+            if data['route'] not in READ_ROUTES:
+                return {'status': 'Error: This is a read-only replica.'}
+            # Readers that need a write we haven't got yet, or fresher
+            # data than we're sure to have, go to the primary
+            max_staleness = data.get('max_staleness')
+            if (not self.synced or self.version < (data.get('min_version') or 0)
+                    or (max_staleness is not None
+                        and time.monotonic() - self.synced_at > max_staleness)):
+                return {'status': 'Error: Replica is behind.', 'behind': True}
 
-        # Main accept() loop
-        while True:
-            # Accept a new request from a client
-            new_sock, client_addr = productdb_socket.accept()
-            print(f"Accepted connection from {client_addr}.")
-            data = self.handler.recv(new_sock)
-
-            # Figure out what function was called from the header and call it
-            route = self._route_request(data['route'])
-            if route:
-                response = route(data)
-            else:
-                response = {'staus': 'Error: Invalid database route.'}
+        route = self._route_request(data['route'])
+        if route is None:
+            return {'status': 'Error: Invalid database route.', 'version': self.version}
+        if self.id_offset:
+            self._to_local(data)
 
-            # Send the response
-            self.handler.send(new_sock, response)
+        if self.snapshots is not None and data['route'] in READ_ROUTES:
+            # Taken before pinning, so the data is at least this new
+            version = self.version
+            with self.snapshots.read() as store:
+                self._reading.store = store
+                try:
+                    resp = route(data)
+                finally:
+                    self._reading.store = None
+        else:
+            # Writes (and, without snapshots, everything) go one at a
+            # time. A replica's follower thread also takes this lock.
+            with self.lock:
+                resp = route(data)
+                version = self.version
 
-            # No longer need that connection
-            new_sock.close()
-            print(f"Disconnected from {client_addr}.")
+        if self.id_offset:
+            self._to_global(resp)
+        resp['version'] = version
+        return resp
+
+    def serve(self, mode: str = 'asyncio', workers: int = 32):
+        """
+        :param mode: 'asyncio' serves all connections concurrently on an
+                     event loop. 'serial' answers one request at a time.
+                     Either way requests are handled one at a time, so
+                     the database is never touched by two at once.
+                     'thread' handles them on a pool of threads, where
+                     reads run at once on snapshots of the store and
+                     writes go one at a time.
+        :param workers: Threads for the 'thread' mode.
+        """
+        # Get a listening socket from the TCPHandler
+        if self.replica is None:
+            add_shard_addresses(self.handler, self.shard + 1)
+            productdb_socket = self.handler.get_listener(shard_name(self.shard))
+            # Replicas get the primary's compactions through the change stream
+            if self.storage != 'mmap':
+                threading.Thread(target=self._compact, daemon=True).start()
+        else:
+            add_shard_addresses(self.handler, self.shard + 1, self.replica + 1)
+            productdb_socket = self.handler.get_listener(replica_name(self.shard, self.replica))
+            self.follow()
+        print("Product database waiting for incoming connections.\n")
+
+        # Main loop. Connections are kept open between requests.
+        if mode == 'thread':
+            self.enable_snapshots()
+            AsyncServer(self.handler, self._handle_request, workers).run(productdb_socket)
+        elif mode == 'asyncio':
+            AsyncServer(self.handler, self._handle_request).run(productdb_socket)
+        else:
+            self.handler.serve_forever(productdb_socket, self._handle_request)
 
 
 if __name__ == "__main__":
-    product_db = ProductDB()
-    product_db.serve()
\ No newline at end of file
+    # python product_db.py [mode] [storage] [data_dir] [shard] [replica]
+    # A data_dir of '-' keeps the products in memory.
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'asyncio'
+    storage = sys.argv[2] if len(sys.argv) > 2 else 'dict'
+    data_dir = sys.argv[3] if len(sys.argv) > 3 and sys.argv[3] != '-' else None
+    shard = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+    replica = int(sys.argv[5]) if len(sys.argv) > 5 else None
+    product_db = ProductDB(storage, data_dir, shard, replica)
+    product_db.serve(mode)
\ No newline at end of file
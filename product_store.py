@@ -0,0 +1,1114 @@
+import os
+import copy
+import heapq
+from bisect import bisect_right
+from operator import itemgetter
+import numpy as np
+
+
+def id_ranges(ids: list) -> list:
+    """
+    Turns sorted unit ids into [first, last] pairs, one per run
+    of consecutive ids.
+    """
+    ranges = []
+    for _id in ids:
+        if ranges and ranges[-1][1] == _id - 1:
+            ranges[-1][1] = _id
+        else:
+            ranges.append([_id, _id])
+    return ranges
+
+
+class Listing:
+    """
+    Everything one sell_item call listed: the item's fields once, and
+    quantity units with consecutive ids starting at first_id. A unit
+    is only tracked on its own once its (status, buyer) differs from
+    the listing's.
+    """
+    __slots__ = ('fields', 'first_id', 'quantity', 'base', 'unit_states', 'counts')
+
+    def __init__(self, fields: dict, first_id: int, quantity: int):
+        self.fields = fields
+        self.first_id = first_id
+        self.quantity = quantity
+        # The (status, buyer) every unit starts with
+        self.base = (fields['status'], fields.get('buyer'))
+        # Unit id -> (status, buyer), for units no longer in base
+        self.unit_states = {}
+        # How many units are in each (status, buyer)
+        self.counts = {self.base: quantity}
+
+    def __getstate__(self) -> tuple:
+        # A plain tuple pickles much faster than the default for slots
+        return (self.fields, self.first_id, self.quantity, self.base,
+                self.unit_states, self.counts)
+
+    def __setstate__(self, state: tuple) -> None:
+        (self.fields, self.first_id, self.quantity, self.base,
+         self.unit_states, self.counts) = state
+
+    def __contains__(self, _id: int) -> bool:
+        return self.first_id <= _id < self.first_id + self.quantity
+
+    def state(self, _id: int) -> tuple:
+        return self.unit_states.get(_id, self.base)
+
+    def set_state(self, _id: int, state: tuple) -> None:
+        old = self.state(_id)
+        if state == self.base:
+            del self.unit_states[_id]
+        else:
+            self.unit_states[_id] = state
+
+        self.counts[old] -= 1
+        if self.counts[old] == 0:
+            del self.counts[old]
+        self.counts[state] = self.counts.get(state, 0) + 1
+
+    def ids(self, state: tuple):
+        """
+        Sorted ids of the units in state.
+        """
+        if state == self.base:
+            if not self.unit_states:
+                return range(self.first_id, self.first_id + self.quantity)
+            return [_id for _id in range(self.first_id, self.first_id + self.quantity)
+                    if _id not in self.unit_states]
+        return sorted(_id for _id, s in self.unit_states.items() if s == state)
+
+    def ranges(self, state: tuple) -> list:
+        """
+        Ids of the units in state as [first, last] pairs. For the
+        listing's own state these are the gaps between the units
+        that left it, so the whole range is never walked.
+        """
+        if state != self.base:
+            return id_ranges(self.ids(state))
+
+        ranges, start = [], self.first_id
+        for _id in sorted(self.unit_states):
+            if _id > start:
+                ranges.append([start, _id - 1])
+            start = _id + 1
+        if start < self.first_id + self.quantity:
+            ranges.append([start, self.first_id + self.quantity - 1])
+        return ranges
+
+    def unit(self, _id: int, state: tuple = None) -> dict:
+        """
+        One unit as a product dictionary.
+        """
+        status, buyer = state or self.state(_id)
+        return {**self.fields, 'status': status, 'buyer': buyer, 'id': _id}
+
+    def view(self, want, expand: bool = True) -> list:
+        """
+        The units whose (status, buyer) passes want, in id order.
+
+        :param expand: If False, returns one record per (status, buyer)
+                       instead, with 'quantity' and 'ids' ([first, last]
+                       pairs) added and 'id' set to the first unit's id.
+        """
+        states = [s for s in self.counts if want(s)]
+        if expand:
+            fields = self.fields
+            units = [{**fields, 'status': s[0], 'buyer': s[1], 'id': _id}
+                     for s in states for _id in self.ids(s)]
+            if len(states) > 1:
+                units.sort(key=itemgetter('id'))
+            return units
+
+        records = []
+        for s in states:
+            ranges = self.ranges(s)
+            record = self.unit(ranges[0][0], s)
+            record['quantity'] = self.counts[s]
+            record['ids'] = ranges
+            records.append(record)
+        records.sort(key=itemgetter('id'))
+        return records
+
+
+def with_archived(records: list, archived, method: str, *args) -> list:
+    """
+    Adds the matching records from the archive, if there is one, to
+    records, keeping them in id order.
+    """
+    if archived is None or not archived.listings:
+        return records
+    return list(heapq.merge(records, getattr(archived, method)(*args), key=itemgetter('id')))
+
+
+def ops_with_archived(listing_ops, archived):
+    """
+    Yields a store's calls to rebuild it, from (first id, calls) for
+    each of its own listings, with the archived listings added in id
+    order so they get their ids back, then archived again.
+    """
+    merged = heapq.merge(listing_ops, archived._listing_ops(), key=itemgetter(0))
+    for _, calls in merged:
+        yield from calls
+    if archived.listings:
+        yield 'archive', [list(archived._starts)]
+
+
+def wants(status: str = None, buyer: str = None):
+    """
+    Filter on a unit's (status, buyer) for Listing.view.
+    """
+    return lambda state: ((status is None or state[0] == status)
+                          and (buyer is None or state[1] == buyer))
+
+
+class ProductStore:
+    """
+    Default storage engine for the product database. Each sell_item
+    call is kept as one Listing, with indexes on top:
+
+        listings:        every listing, in id order
+        keyword_index:   keyword -> listings with units for sale
+        category_index:  category -> listings with units for sale
+        seller_index:    seller -> status -> listings with units in it
+        buyer_index:     buyer -> status -> listings with units in it
+
+    Listings are keyed by their first unit id. Every engine has the
+    same methods and returns the same dictionaries, so ProductDB
+    doesn't care which one it's using. Reads return one dictionary
+    per unit, or per listing and (status, buyer) if expand is False.
+
+    Listings with nothing left for sale can be moved to the archive
+    (itself a ProductStore) with archive(). Lookups by id, seller
+    and buyer still reach them, but searches and all() only see the
+    listings still in the store.
+    """
+
+    def __init__(self, archived: bool = True):
+        """
+        :param archived: Whether to have an archive. The archive
+                         itself doesn't.
+        """
+        self.listings = []
+        # First unit id of every listing, for finding a unit's listing
+        self._starts = []
+        self.listings_by_id = {}
+        self._next_id = 1
+        self.archived = ProductStore(archived=False) if archived else None
+
+        # Ids of the listings with units for sale, by keyword and by category
+        self.keyword_index = {}
+        self.category_index = {}
+        # Ids of each seller's and each buyer's listings, by status
+        self.seller_index = {}
+        self.buyer_index = {}
+
+    def __len__(self) -> int:
+        return self._next_id - 1
+
+    def _find(self, _id: int) -> Listing:
+        """
+        The listing holding the unit with this id, or None. Archived
+        listings aren't searched.
+        """
+        if type(_id) is not int:
+            return None
+        i = bisect_right(self._starts, _id) - 1
+        if i >= 0 and _id in self.listings[i]:
+            return self.listings[i]
+        return None
+
+    def insert(self, listing: Listing) -> None:
+        """
+        Adds a listing that already has its ids, e.g. one being
+        archived, indexing every state its units are in.
+        """
+        i = bisect_right(self._starts, listing.first_id)
+        self.listings.insert(i, listing)
+        self._starts.insert(i, listing.first_id)
+        self.listings_by_id[listing.first_id] = listing
+        for state in listing.counts:
+            self._index_state(listing, state)
+        self._next_id = max(self._next_id, listing.first_id + listing.quantity)
+
+    def _index_state(self, listing: Listing, state: tuple) -> None:
+        """
+        Called when a listing gets its first unit in state.
+        """
+        (status, buyer), lid, fields = state, listing.first_id, listing.fields
+        self.seller_index.setdefault(fields['seller'], {}).setdefault(status, set()).add(lid)
+        if buyer is not None:
+            self.buyer_index.setdefault(buyer, {}).setdefault(status, set()).add(lid)
+
+        if status == 'For Sale':
+            for keyword in fields['keywords']:
+                self.keyword_index.setdefault(keyword, set()).add(lid)
+            self.category_index.setdefault(fields['category'], set()).add(lid)
+
+    def _unindex_state(self, listing: Listing, state: tuple) -> None:
+        """
+        Called when the last of a listing's units leaves state.
+        """
+        (status, buyer), lid, fields = state, listing.first_id, listing.fields
+        if buyer is not None:
+            self.buyer_index[buyer][status].discard(lid)
+        # Units bought by someone else may still have this status
+        if any(s[0] == status for s in listing.counts):
+            return
+
+        self.seller_index[fields['seller']][status].discard(lid)
+        if status == 'For Sale':
+            for keyword in fields['keywords']:
+                self.keyword_index[keyword].discard(lid)
+            self.category_index[fields['category']].discard(lid)
+
+    def _listing_ids(self, index: dict, user: str, status: str = None) -> list:
+        """
+        Sorted ids of a user's listings in the seller or buyer index,
+        either with one status or with any status.
+        """
+        by_status = index.get(user, {})
+        if status is not None:
+            return sorted(by_status.get(status, ()))
+        return sorted(set(lid for lids in by_status.values() for lid in lids))
+
+    def _view(self, lids, want, expand: bool) -> list:
+        out = []
+        for lid in lids:
+            out.extend(self.listings_by_id[lid].view(want, expand))
+        return out
+
+    def add_listing(self, item: dict, quantity: int) -> list:
+        """
+        Stores one copy of the item as a listing of quantity units.
+
+        :returns: The new units' ids.
+        """
+        if quantity < 1:
+            return []
+
+        fields = copy.deepcopy(item)
+        listing = Listing(fields, self._next_id, quantity)
+        self._next_id += quantity
+
+        self.listings.append(listing)
+        self._starts.append(listing.first_id)
+        self.listings_by_id[listing.first_id] = listing
+        self._index_state(listing, listing.base)
+        return list(range(listing.first_id, listing.first_id + quantity))
+
+    def get(self, _id: int) -> dict:
+        """
+        :returns: The unit with this id, or None.
+        """
+        listing = self._find(_id)
+        if listing is not None:
+            return listing.unit(_id)
+        return self.archived.get(_id) if self.archived is not None else None
+
+    def set_status(self, _id: int, status: str, buyer: str = None) -> bool:
+        """
+        Moves a unit to a new status (and buyer, if given), keeping
+        every index up to date. All status changes go through here.
+
+        :returns: False if there's no unit with this id.
+        """
+        listing = self._find(_id)
+        if listing is None:
+            if self.archived is not None:
+                return self.archived.set_status(_id, status, buyer)
+            return False
+
+        old = listing.state(_id)
+        new = (status, buyer if buyer is not None else old[1])
+        if new != old:
+            listing.set_state(_id, new)
+            if old not in listing.counts:
+                self._unindex_state(listing, old)
+            if listing.counts[new] == 1:
+                self._index_state(listing, new)
+        return True
+
+    def query(self, category: int, keywords: list, min_price: float = None,
+              max_price: float = None, expand: bool = True) -> list:
+        """
+        Units for sale that are either in the category or share at
+        least one keyword with the query, optionally within a price
+        range.
+        """
+        # Union of the matching index entries
+        lids = set(self.category_index.get(category, ()))
+        for keyword in keywords:
+            lids |= self.keyword_index.get(keyword, set())
+
+        lids = sorted(lids)
+        if min_price is not None:
+            lids = [lid for lid in lids if self.listings_by_id[lid].fields['price'] >= min_price]
+        if max_price is not None:
+            lids = [lid for lid in lids if self.listings_by_id[lid].fields['price'] <= max_price]
+        return self._view(lids, wants('For Sale'), expand)
+
+    def for_seller(self, seller: str, status: str = None, expand: bool = True) -> list:
+        lids = self._listing_ids(self.seller_index, seller, status)
+        return with_archived(self._view(lids, wants(status), expand),
+                             self.archived, 'for_seller', seller, status, expand)
+
+    def for_buyer(self, buyer: str, status: str = None, expand: bool = True) -> list:
+        lids = self._listing_ids(self.buyer_index, buyer, status)
+        return with_archived(self._view(lids, wants(status, buyer), expand),
+                             self.archived, 'for_buyer', buyer, status, expand)
+
+    def all(self, expand: bool = True) -> list:
+        out = []
+        for listing in self.listings:
+            out.extend(listing.view(wants(), expand))
+        return out
+
+    def dead_listings(self, limit: int) -> list:
+        """
+        First ids of up to limit listings with no units for sale,
+        which can be archived.
+        """
+        dead = []
+        for listing in self.listings:
+            if not any(state[0] == 'For Sale' for state in listing.counts):
+                dead.append(listing.first_id)
+                if len(dead) == limit:
+                    break
+        return dead
+
+    def archive(self, first_ids: list) -> int:
+        """
+        Moves listings out of the store and into the archive.
+
+        :returns: How many were moved.
+        """
+        moved = [self.listings_by_id.pop(lid) for lid in first_ids if lid in self.listings_by_id]
+        for listing in moved:
+            for state in listing.counts:
+                self._drop_state(listing, state)
+            self.archived.insert(listing)
+
+        if moved:
+            gone = set(listing.first_id for listing in moved)
+            self.listings = [l for l in self.listings if l.first_id not in gone]
+            self._starts = [l.first_id for l in self.listings]
+        return len(moved)
+
+    def _drop_state(self, listing: Listing, state: tuple) -> None:
+        """
+        Removes every index entry for a listing's units in state.
+        """
+        (status, buyer), lid, fields = state, listing.first_id, listing.fields
+        self.seller_index[fields['seller']][status].discard(lid)
+        if buyer is not None:
+            self.buyer_index[buyer][status].discard(lid)
+        if status == 'For Sale':
+            for keyword in fields['keywords']:
+                self.keyword_index[keyword].discard(lid)
+            self.category_index[fields['category']].discard(lid)
+
+    def _listing_ops(self):
+        """
+        Yields (first id, calls that add the listing and its unit
+        states) for every listing, in id order.
+        """
+        for listing in self.listings:
+            calls = [('add_listing', [listing.fields, listing.quantity])]
+            calls += [('set_status', [_id, *listing.unit_states[_id]])
+                      for _id in sorted(listing.unit_states)]
+            yield listing.first_id, calls
+
+    def ops(self):
+        """
+        Yields the add_listing, set_status and archive calls, as
+        (method, args), that rebuild this store from empty with the
+        same ids.
+        """
+        return ops_with_archived(self._listing_ops(), self.archived)
+
+
+class Interner:
+    """
+    Dictionary encoding for a column of strings. Each distinct
+    string is stored once and the column holds its integer code.
+    """
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value: str) -> int:
+        """
+        The code for value, adding it if it's new.
+        """
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    def lookup(self, value: str) -> int:
+        """
+        The code for value, or -1 if it's never been stored.
+        """
+        return self.codes.get(value, -1)
+
+
+class ColumnarProductStore:
+    """
+    Storage engine that keeps each field in its own NumPy array
+    instead of a dictionary per item. Fields shared by a listing's
+    units (name, category, condition, price, seller, keywords) get
+    one row per listing, and each unit only has its status, buyer
+    and listing. Strings are dictionary-encoded, and keywords are
+    kept as one flat array of codes with the listing each belongs
+    to. Filters run as vectorized masks over the columns, and
+    dictionaries are only built for the units returned.
+
+    Takes a small fraction of the memory of ProductStore, but only
+    keeps the fields listed in ProductDB's docstring. Archived
+    listings are kept in a ProductStore, and their rows are dropped.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        # One row per unit. A listing's units are consecutive rows, so
+        # a unit's id is its row's offset from the listing's first row
+        # plus the listing's first id.
+        self._n = 0
+        self._next_id = 1
+        self.columns = {
+            'status': np.empty(capacity, np.int8),
+            'buyer': np.empty(capacity, np.int32),
+            'listing': np.empty(capacity, np.int32)
+        }
+
+        # One row per listing
+        self._n_listings = 0
+        self.listing_columns = {
+            'first_id': np.empty(capacity, np.int64),
+            'row_start': np.empty(capacity, np.int64),
+            'name': np.empty(capacity, np.int32),
+            'category': np.empty(capacity, np.int32),
+            'condition': np.empty(capacity, np.int16),
+            'price': np.empty(capacity, np.float64),
+            'seller': np.empty(capacity, np.int32),
+            # Where each listing's keywords start in the flat arrays, and how many
+            'kw_start': np.empty(capacity, np.int64),
+            'kw_count': np.empty(capacity, np.int8)
+        }
+
+        # Every listing's keyword codes back to back, and the listing each came from
+        self._kw_n = 0
+        self.kw_codes = np.empty(capacity * 2, np.int32)
+        self.kw_listings = np.empty(capacity * 2, np.int32)
+
+        self.strings = {
+            'name': Interner(),
+            'condition': Interner(),
+            'seller': Interner(),
+            'status': Interner(),
+            'keywords': Interner()
+        }
+        # Buyers share the sellers' table since both are usernames
+        self.strings['buyer'] = self.strings['seller']
+        self.archived = ProductStore(archived=False)
+
+    def __len__(self) -> int:
+        return self._next_id - 1
+
+    def _grow(self, arrays: dict, needed: int) -> None:
+        """
+        Doubles every array in arrays until it can hold needed rows.
+        """
+        for key, arr in arrays.items():
+            if len(arr) < needed:
+                new_arr = np.empty(max(needed, 2 * len(arr)), arr.dtype)
+                new_arr[:len(arr)] = arr
+                arrays[key] = new_arr
+
+    def _row_starts(self, listings):
+        """
+        The rows of the given listings' first units.
+        """
+        return self.listing_columns['row_start'][listings]
+
+    def _row(self, _id: int) -> int:
+        """
+        The row holding this id, or -1 if it isn't in the store.
+        """
+        n = self._n_listings
+        if type(_id) is not int or not 0 < _id <= len(self) or not n:
+            return -1
+        first_ids = self.listing_columns['first_id'][:n]
+        lrow = int(np.searchsorted(first_ids, _id, 'right')) - 1
+        if lrow < 0:
+            return -1
+        row = int(self._row_starts(lrow)) + _id - int(first_ids[lrow])
+        end = int(self._row_starts(lrow + 1)) if lrow + 1 < n else self._n
+        return row if row < end else -1
+
+    def _ids(self, rows: np.ndarray, listings: np.ndarray) -> np.ndarray:
+        """
+        The ids of the units in rows, which belong to listings.
+        """
+        return self.listing_columns['first_id'][listings] + rows - self._row_starts(listings)
+
+    def _to_dicts(self, rows) -> list:
+        """
+        Builds the item dictionaries for the given rows. Columns are
+        gathered for all the rows at once rather than row by row.
+        """
+        rows = np.asarray(rows, np.int64)
+        cols, lcols, strings = self.columns, self.listing_columns, self.strings
+        listings = cols['listing'][rows]
+
+        def decode(field, column):
+            values = strings[field].values
+            return [values[c] if c >= 0 else None for c in column.tolist()]
+
+        return [
+            {
+                'name': name,
+                'category': category,
+                'keywords': kws,
+                'condition': condition,
+                'price': price,
+                'seller': seller,
+                'status': status,
+                'buyer': buyer,
+                'id': _id
+            }
+            for name, category, kws, condition, price, seller, status, buyer, _id in zip(
+                self._names(listings), lcols['category'][listings].tolist(),
+                self._keywords(listings), decode('condition', lcols['condition'][listings]),
+                lcols['price'][listings].tolist(), decode('seller', lcols['seller'][listings]),
+                decode('status', cols['status'][rows]), decode('buyer', cols['buyer'][rows]),
+                self._ids(rows, listings).tolist())
+        ]
+
+    def _names(self, listings: np.ndarray) -> list:
+        """
+        The names of the given listings.
+        """
+        values = self.strings['name'].values
+        return [values[c] for c in self.listing_columns['name'][listings].tolist()]
+
+    def _keywords(self, listings: np.ndarray) -> list:
+        """
+        The keyword lists of the given listings.
+        """
+        # Positions of every wanted keyword in the flat arrays
+        lcols = self.listing_columns
+        counts = lcols['kw_count'][listings].astype(np.int64)
+        ends = np.cumsum(counts)
+        positions = (np.repeat(lcols['kw_start'][listings] - (ends - counts), counts)
+                     + np.arange(ends[-1] if len(ends) else 0))
+        kw_values = self.strings['keywords'].values
+        flat = [kw_values[c] for c in self.kw_codes[positions].tolist()]
+        keywords, start = [], 0
+        for count in counts.tolist():
+            keywords.append(flat[start:start + count])
+            start += count
+        return keywords
+
+    def _keyword_matches(self, codes: list) -> np.ndarray:
+        """
+        Indexes of the listings with at least one of the keyword codes.
+        """
+        hits = np.isin(self.kw_codes[:self._kw_n], codes)
+        return self.kw_listings[:self._kw_n][hits]
+
+    def _collapse(self, rows) -> list:
+        """
+        Like _to_dicts, but with one record per listing and
+        (status, buyer), as ProductStore returns when expand is False.
+        """
+        rows = np.asarray(rows, np.int64)
+        if not len(rows):
+            return []
+
+        cols = self.columns
+        listing, status, buyer = cols['listing'][rows], cols['status'][rows], cols['buyer'][rows]
+        order = np.lexsort((rows, buyer, status, listing))
+        rows, listing, status, buyer = rows[order], listing[order], status[order], buyer[order]
+
+        # Where each group, and each run of consecutive ids, begins
+        new_group = np.ones(len(rows), bool)
+        new_group[1:] = ((listing[1:] != listing[:-1]) | (status[1:] != status[:-1])
+                         | (buyer[1:] != buyer[:-1]))
+        new_run = new_group.copy()
+        new_run[1:] |= rows[1:] != rows[:-1] + 1
+
+        group_starts = np.flatnonzero(new_group)
+        quantities = np.diff(np.append(group_starts, len(rows))).tolist()
+        run_starts = np.flatnonzero(new_run)
+        run_ends = np.append(run_starts[1:], len(rows)) - 1
+        run_groups = (np.cumsum(new_group)[run_starts] - 1).tolist()
+        ranges = [[] for _ in quantities]
+        ids = self._ids(rows, listing)
+        for g, first, last in zip(run_groups, ids[run_starts].tolist(), ids[run_ends].tolist()):
+            ranges[g].append([first, last])
+
+        records = self._to_dicts(rows[group_starts])
+        for record, quantity, ids in zip(records, quantities, ranges):
+            record['quantity'] = quantity
+            record['ids'] = ids
+        records.sort(key=itemgetter('id'))
+        return records
+
+    def _view(self, mask: np.ndarray, expand: bool) -> list:
+        rows = np.flatnonzero(mask)
+        return self._to_dicts(rows) if expand else self._collapse(rows)
+
+    def _equals(self, columns: dict, n: int, field: str, value: str) -> np.ndarray:
+        """
+        Mask of the first n rows of columns whose dictionary-encoded
+        field is value.
+        """
+        code = self.strings[field].lookup(value)
+        if code < 0:
+            return np.zeros(n, bool)
+        return columns[field][:n] == code
+
+    def _unit_mask(self, listing_mask: np.ndarray) -> np.ndarray:
+        """
+        Mask of the units whose listing is in listing_mask.
+        """
+        return listing_mask[self.columns['listing'][:self._n]]
+
+    def add_listing(self, item: dict, quantity: int) -> list:
+        """
+        Appends the item as one listing row and quantity unit rows.
+
+        :returns: The new units' ids.
+        """
+        if quantity < 1:
+            return []
+
+        lrow, first = self._n_listings, self._n
+        keywords = item['keywords']
+        self._grow(self.columns, first + quantity)
+        self._grow(self.listing_columns, lrow + 1)
+        kw_arrays = {'kw_codes': self.kw_codes, 'kw_listings': self.kw_listings}
+        self._grow(kw_arrays, self._kw_n + len(keywords))
+        self.kw_codes, self.kw_listings = kw_arrays['kw_codes'], kw_arrays['kw_listings']
+
+        lcols, strings = self.listing_columns, self.strings
+        first_id = self._next_id
+        lcols['first_id'][lrow] = first_id
+        lcols['row_start'][lrow] = first
+        lcols['name'][lrow] = strings['name'].code(item['name'])
+        lcols['category'][lrow] = item['category']
+        lcols['condition'][lrow] = strings['condition'].code(item['condition'])
+        lcols['price'][lrow] = item['price']
+        lcols['seller'][lrow] = strings['seller'].code(item['seller'])
+        lcols['kw_start'][lrow] = self._kw_n
+        lcols['kw_count'][lrow] = len(keywords)
+        for keyword in keywords:
+            self.kw_codes[self._kw_n] = strings['keywords'].code(keyword)
+            self.kw_listings[self._kw_n] = lrow
+            self._kw_n += 1
+
+        cols, units = self.columns, slice(first, first + quantity)
+        cols['status'][units] = strings['status'].code(item['status'])
+        buyer = item.get('buyer')
+        cols['buyer'][units] = strings['buyer'].code(buyer) if buyer is not None else -1
+        cols['listing'][units] = lrow
+
+        self._n_listings += 1
+        self._n += quantity
+        self._next_id += quantity
+        return list(range(first_id, first_id + quantity))
+
+    def get(self, _id: int) -> dict:
+        row = self._row(_id)
+        return self._to_dicts([row])[0] if row >= 0 else self.archived.get(_id)
+
+    def set_status(self, _id: int, status: str, buyer: str = None) -> bool:
+        row = self._row(_id)
+        if row < 0:
+            return self.archived.set_status(_id, status, buyer)
+
+        self.columns['status'][row] = self.strings['status'].code(status)
+        if buyer is not None:
+            self.columns['buyer'][row] = self.strings['buyer'].code(buyer)
+        return True
+
+    def query(self, category: int, keywords: list, min_price: float = None,
+              max_price: float = None, expand: bool = True) -> list:
+        n, lcols = self._n_listings, self.listing_columns
+        listing_mask = lcols['category'][:n] == category
+
+        codes = [c for c in map(self.strings['keywords'].lookup, keywords) if c >= 0]
+        if codes:
+            listing_mask[self._keyword_matches(codes)] = True
+
+        if min_price is not None:
+            listing_mask &= lcols['price'][:n] >= min_price
+        if max_price is not None:
+            listing_mask &= lcols['price'][:n] <= max_price
+
+        mask = self._unit_mask(listing_mask)
+        mask &= self._equals(self.columns, self._n, 'status', 'For Sale')
+        return self._view(mask, expand)
+
+    def for_seller(self, seller: str, status: str = None, expand: bool = True) -> list:
+        mask = self._unit_mask(self._equals(self.listing_columns, self._n_listings,
+                                            'seller', seller))
+        if status is not None:
+            mask &= self._equals(self.columns, self._n, 'status', status)
+        return with_archived(self._view(mask, expand),
+                             self.archived, 'for_seller', seller, status, expand)
+
+    def for_buyer(self, buyer: str, status: str = None, expand: bool = True) -> list:
+        mask = self._equals(self.columns, self._n, 'buyer', buyer)
+        if status is not None:
+            mask &= self._equals(self.columns, self._n, 'status', status)
+        return with_archived(self._view(mask, expand),
+                             self.archived, 'for_buyer', buyer, status, expand)
+
+    def all(self, expand: bool = True) -> list:
+        return self._view(np.ones(self._n, bool), expand)
+
+    def dead_listings(self, limit: int) -> list:
+        """
+        First ids of up to limit listings with no units for sale,
+        which can be archived.
+        """
+        n = self._n_listings
+        alive = np.zeros(n, bool)
+        alive[self.columns['listing'][:self._n][
+            self._equals(self.columns, self._n, 'status', 'For Sale')]] = True
+        return self.listing_columns['first_id'][:n][~alive][:limit].tolist()
+
+    def archive(self, first_ids: list) -> int:
+        """
+        Moves listings into the archive and drops their rows, moving
+        the rows after them up.
+
+        :returns: How many were moved.
+        """
+        n, lcols = self._n_listings, self.listing_columns
+        wanted = np.asarray(first_ids, np.int64)
+        lrows = np.searchsorted(lcols['first_id'][:n], wanted)
+        found = lrows < n
+        found[found] = lcols['first_id'][lrows[found]] == wanted[found]
+        lrows = np.unique(lrows[found])
+        if not len(lrows):
+            return 0
+
+        for first_id, calls in self._listing_ops(lrows):
+            (_, (item, quantity)), changes = calls[0], calls[1:]
+            listing = Listing(item, first_id, quantity)
+            for _, (_id, status, buyer) in changes:
+                listing.set_state(_id, (status, buyer))
+            self.archived.insert(listing)
+
+        # Rows of the listings that stay, and where each listing moves to
+        keep = np.ones(n, bool)
+        keep[lrows] = False
+        moved_to = (np.cumsum(keep) - 1).astype(np.int32)
+        starts = self._row_starts(np.arange(n))
+        quantities = np.diff(np.append(starts, self._n))[keep]
+
+        cols = self.columns
+        keep_units = keep[cols['listing'][:self._n]]
+        for key, arr in cols.items():
+            cols[key] = arr[:self._n][keep_units]
+        cols['listing'] = moved_to[cols['listing']]
+        keep_kws = keep[self.kw_listings[:self._kw_n]]
+        self.kw_codes = self.kw_codes[:self._kw_n][keep_kws]
+        self.kw_listings = moved_to[self.kw_listings[:self._kw_n][keep_kws]]
+
+        for key, arr in lcols.items():
+            lcols[key] = arr[:n][keep]
+        kw_counts = lcols['kw_count'].astype(np.int64)
+        lcols['kw_start'] = np.cumsum(kw_counts) - kw_counts
+        lcols['row_start'] = np.cumsum(quantities) - quantities
+        self._n, self._n_listings, self._kw_n = len(cols['status']), len(quantities), len(self.kw_codes)
+        return len(lrows)
+
+    def _listing_ops(self, lrows: np.ndarray = None):
+        """
+        Yields (first id, calls that add the listing and its unit
+        states) for the given listings, or every listing, in id
+        order. Each listing is added with the status of its first
+        unit and no buyer, and set_status is called for every unit
+        that differs.
+        """
+        n, cols = self._n_listings, self.columns
+        if not n:
+            return
+        all_starts = self._row_starts(np.arange(n))
+        all_ends = np.append(all_starts[1:], self._n)
+        if lrows is None:
+            lrows = np.arange(n)
+        starts, ends = all_starts[lrows], all_ends[lrows]
+        items = self._to_dicts(starts)
+
+        # Units with another status than their listing's first unit, or a buyer
+        listing = cols['listing'][:self._n]
+        status, buyer = cols['status'][:self._n], cols['buyer'][:self._n]
+        differs = np.flatnonzero((status != status[all_starts][listing]) | (buyer >= 0))
+        los = np.searchsorted(differs, starts).tolist()
+        his = np.searchsorted(differs, ends).tolist()
+        statuses, buyers = self.strings['status'].values, self.strings['buyer'].values
+
+        for item, start, end, lo, hi in zip(items, starts.tolist(), ends.tolist(), los, his):
+            first_id = item.pop('id')
+            item['buyer'] = None
+            calls = [('add_listing', [item, end - start])]
+            for row in differs[lo:hi].tolist():
+                b = int(buyer[row])
+                calls.append(('set_status', [first_id + row - start, statuses[status[row]],
+                                             buyers[b] if b >= 0 else None]))
+            yield first_id, calls
+
+    def ops(self):
+        """
+        Yields the add_listing, set_status and archive calls, as
+        (method, args), that rebuild this store from empty with the
+        same ids.
+        """
+        return ops_with_archived(self._listing_ops(), self.archived)
+
+
+class MappedInterner(Interner):
+    """
+    Interner that calls on_new(self, value) for every new string,
+    so the store can save it.
+    """
+
+    def __init__(self, on_new):
+        super().__init__()
+        self.on_new = on_new
+
+    def code(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = super().code(value)
+            self.on_new(self, value)
+        return code
+
+
+class MappedProductStore(ColumnarProductStore):
+    """
+    Storage engine that keeps the catalog in memory-mapped files
+    instead of on the heap. It can hold more products than fit in
+    memory, and it opens almost instantly because the OS only pages
+    records in when they're read.
+
+    Each segment file holds fixed-size records:
+
+        units.dat       status, buyer and listing of every unit,
+                        so a unit's id gives its offset
+        listings.dat    the fields shared by a listing's units
+        heap.dat        names and other strings, as UTF-8
+        strings.dat     where each dictionary-encoded string is in
+                        the heap, read back into Interners on open
+        header.dat      how much of each of the above is in use
+
+    The columns ColumnarProductStore works on are views of one field
+    of the mapped records, so every query and lookup reads straight
+    from the mapped pages. Only the fields a route returns get decoded.
+    Changes go to the page cache right away, so they survive the
+    process dying. flush() writes them to the disk.
+    """
+
+    MAX_KEYWORDS = 5
+    DTYPES = {
+        'header': np.dtype(np.int64),
+        'units': np.dtype([('buyer', np.int32), ('listing', np.int32), ('status', np.int8)]),
+        'listings': np.dtype([
+            ('first_id', np.int64),
+            ('price', np.float64),
+            # Where the name is in the heap, and its length in bytes
+            ('name_start', np.int64),
+            ('name_len', np.int32),
+            ('category', np.int32),
+            ('seller', np.int32),
+            ('condition', np.int16),
+            # Keyword codes, -1 for unused slots
+            ('keywords', np.int32, (MAX_KEYWORDS,))
+        ]),
+        'heap': np.dtype(np.uint8),
+        'strings': np.dtype([('table', np.int8), ('start', np.int64), ('len', np.int32)])
+    }
+    # Slots in header.dat
+    N_UNITS, N_LISTINGS, HEAP_USED, N_STRINGS = range(4)
+    # Interners whose strings are saved, by their number in strings.dat
+    TABLES = ['condition', 'seller', 'status', 'keywords']
+
+    def __init__(self, path: str, capacity: int = 1024):
+        """
+        :param path: Directory holding the segment files. Created if
+                     it doesn't exist, otherwise the catalog in it is
+                     opened.
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.maps = {
+            'header': self._map('header', 4),
+            'units': self._map('units', capacity),
+            'listings': self._map('listings', capacity),
+            'heap': self._map('heap', capacity * 32),
+            'strings': self._map('strings', 64)
+        }
+        self.header = self.maps['header'].view(np.ndarray)
+
+        self.strings = {table: MappedInterner(self._save_string) for table in self.TABLES}
+        # Buyers share the sellers' table since both are usernames
+        self.strings['buyer'] = self.strings['seller']
+        # Always empty, since records stay where they're written
+        self.archived = ProductStore(archived=False)
+        self._bind()
+        for table, start, length in self.maps['strings'][:self._header(self.N_STRINGS)].tolist():
+            interner = self.strings[self.TABLES[table]]
+            value = str(self.heap[start:start + length], 'utf-8')
+            interner.codes[value] = len(interner.values)
+            interner.values.append(value)
+
+    def _map(self, name: str, capacity: int) -> np.memmap:
+        """
+        Maps a segment file, first growing it to hold capacity records.
+        """
+        filename = os.path.join(self.path, name + '.dat')
+        dtype = self.DTYPES[name]
+        size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        if size < capacity * dtype.itemsize:
+            with open(filename, 'ab') as f:
+                f.truncate(capacity * dtype.itemsize)
+            size = capacity * dtype.itemsize
+        return np.memmap(filename, dtype, 'r+', shape=(size // dtype.itemsize,))
+
+    def _ensure(self, name: str, needed: int) -> None:
+        """
+        Doubles a segment file until it can hold needed records.
+        """
+        old = self.maps[name]
+        if len(old) >= needed:
+            return
+        old.flush()
+        self.maps[name] = self._map(name, max(needed, 2 * len(old)))
+        self._bind()
+
+    def _bind(self) -> None:
+        """
+        Points the columns at the current mappings.
+        """
+        # Plain ndarray views skip np.memmap's overhead on every operation
+        units = self.maps['units'].view(np.ndarray)
+        listings = self.maps['listings'].view(np.ndarray)
+        self.columns = {field: units[field] for field in units.dtype.names}
+        self.listing_columns = {field: listings[field] for field in listings.dtype.names}
+        self.heap = memoryview(self.maps['heap'].view(np.ndarray))
+
+    def __len__(self) -> int:
+        return self._n
+
+    def _row_starts(self, listings):
+        # Nothing is archived, so a unit's id is still its row + 1
+        return self.listing_columns['first_id'][listings] - 1
+
+    def dead_listings(self, limit: int) -> list:
+        return []
+
+    def _header(self, slot: int) -> int:
+        return int(self.header[slot])
+
+    @property
+    def _n(self) -> int:
+        return self._header(self.N_UNITS)
+
+    @property
+    def _n_listings(self) -> int:
+        return self._header(self.N_LISTINGS)
+
+    def _put(self, raw: bytes) -> int:
+        """
+        Appends raw to the heap.
+
+        :returns: Where it starts.
+        """
+        start = self._header(self.HEAP_USED)
+        self._ensure('heap', start + len(raw))
+        self.maps['heap'][start:start + len(raw)] = np.frombuffer(raw, np.uint8)
+        self.header[self.HEAP_USED] = start + len(raw)
+        return start
+
+    def _save_string(self, interner: Interner, value: str) -> None:
+        raw = value.encode('utf-8')
+        start = self._put(raw)
+        n = self._header(self.N_STRINGS)
+        self._ensure('strings', n + 1)
+        table = [i for i, t in enumerate(self.TABLES) if self.strings[t] is interner][0]
+        self.maps['strings'][n] = (table, start, len(raw))
+        self.header[self.N_STRINGS] = n + 1
+
+    def _names(self, listings: np.ndarray) -> list:
+        heap, lcols = self.heap, self.listing_columns
+        return [str(heap[start:start + length], 'utf-8')
+                for start, length in zip(lcols['name_start'][listings].tolist(),
+                                         lcols['name_len'][listings].tolist())]
+
+    def _keywords(self, listings: np.ndarray) -> list:
+        values = self.strings['keywords'].values
+        return [[values[c] for c in codes if c >= 0]
+                for codes in self.listing_columns['keywords'][listings].tolist()]
+
+    def _keyword_matches(self, codes: list) -> np.ndarray:
+        keywords = self.listing_columns['keywords'][:self._n_listings]
+        return np.flatnonzero(np.isin(keywords, codes).any(axis=1))
+
+    def add_listing(self, item: dict, quantity: int) -> list:
+        """
+        Appends one listing record and quantity unit records. The
+        counts in the header are bumped last, so a listing is either
+        there in full or not at all.
+
+        :returns: The new units' ids.
+        """
+        if quantity < 1:
+            return []
+        if len(item['keywords']) > self.MAX_KEYWORDS:
+            raise ValueError(f"Items can have at most {self.MAX_KEYWORDS} keywords.")
+
+        strings = self.strings
+        keywords = [strings['keywords'].code(k) for k in item['keywords']]
+        keywords += [-1] * (self.MAX_KEYWORDS - len(keywords))
+        buyer = item.get('buyer')
+        buyer = strings['buyer'].code(buyer) if buyer is not None else -1
+        name = item['name'].encode('utf-8')
+        name_start = self._put(name)
+
+        lrow, first = self._n_listings, self._n
+        self._ensure('listings', lrow + 1)
+        self._ensure('units', first + quantity)
+        self.maps['listings'][lrow] = (
+            first + 1, item['price'], name_start, len(name), item['category'],
+            strings['seller'].code(item['seller']),
+            strings['condition'].code(item['condition']), keywords)
+        self.maps['units'][first:first + quantity] = (
+            buyer, lrow, strings['status'].code(item['status']))
+
+        header = self.header
+        header[self.N_LISTINGS] = lrow + 1
+        header[self.N_UNITS] = first + quantity
+        return list(range(first + 1, first + quantity + 1))
+
+    def flush(self) -> None:
+        """
+        Writes every change to the disk.
+        """
+        for m in self.maps.values():
+            m.flush()
+
+
+# Storage engines ProductDB can be started with
+ENGINES = {
+    'dict': ProductStore,
+    'columnar': ColumnarProductStore,
+    'mmap': MappedProductStore
+}
@@ -6,6 +6,7 @@ import random
 import string
 
 from utils import TCPHandler, ResponseTimeBenchmarker
+from bulk_import import read_batches
 
 pp = pprint.PrettyPrinter()
 
@@ -16,6 +17,8 @@ class SellerClient:
         self.benchmarker = ResponseTimeBenchmarker()
         self.is_logged_in = False
         self.username = ""
+        # Session token from the server, sent with every request that needs a login
+        self.token = None
         self.debug = debug
 
         self.routes = {
@@ -24,6 +27,7 @@ class SellerClient:
             'logout': self.logout,
             'get seller rating': self.get_seller_rating,
             'sell item': self.sell_item,
+            'import items': self.import_items,
             'remove item': self.remove_item,
             'list item': self.list_items,
             'exit': None # handled differently due to different args
@@ -107,6 +111,7 @@ class SellerClient:
             if 'Success' in resp['status']:
                 self.is_logged_in = True
                 self.username = data['username']
+                self.token = resp['token']
                 print("\nYou are now logged in!")
             else:
                 print("\n", resp['status'])
@@ -114,6 +119,7 @@ class SellerClient:
     def logout(self):
         self.is_logged_in = False
         self.username = ""
+        self.token = None
         print("\nYou are now logged out.")
 
     def get_seller_rating(self):
@@ -125,7 +131,7 @@ class SellerClient:
         else:
             data = {
                 'route': 'get_seller_rating',
-                'username': self.username
+                'token': self.token
             }
             
             # Send data to the server and get response back
@@ -170,20 +176,11 @@ class SellerClient:
                     'buyer': None
                 }
             else:
-                item = {
-                    'name': ''.join(random.choice(string.ascii_lowercase) for _ in range(10)),
-                    'category': random.choice(range(10)),
-                    'keywords': self.benchmarker.get_keywords(),
-                    'condition': random.choice(['New', 'Used']),
-                    'price': round(random.uniform(0, 100), 2),
-                    'quantity': random.choice(range(1,6)),
-                    'seller': self.username,
-                    'status': 'For Sale',
-                    'buyer': None
-                }
+                item = self._random_item()
 
             data = {
                 'route': 'sell_item',
+                'token': self.token,
                 'data': item
             }
 
@@ -200,6 +197,52 @@ class SellerClient:
                 print("\nSuccessfully added items with IDs ", resp['ids'])
 
 
+    def _random_item(self) -> dict:
+        return {
+            'name': ''.join(random.choice(string.ascii_lowercase) for _ in range(10)),
+            'category': random.choice(range(10)),
+            'keywords': self.benchmarker.get_keywords(),
+            'condition': random.choice(['New', 'Used']),
+            'price': round(random.uniform(0, 100), 2),
+            'quantity': random.choice(range(1,6)),
+            'seller': self.username,
+            'status': 'For Sale',
+            'buyer': None
+        }
+
+    def sell_items(self, items: list):
+        """
+        Lists many items for sale in one request.
+        """
+        data = {
+            'route': 'sell_items',
+            'token': self.token,
+            'data': {'items': items}
+        }
+
+        start = time.time()
+        resp = self.handler.sendrecv(dest='seller_server', data=data)
+        end = time.time()
+
+        if not self.debug:
+            self.benchmarker.log_response_time(end-start)
+
+        if 'Error' in resp['status']:
+            print(f"\nUnable to list some items for sale: {resp['status']}")
+        else:
+            print(f"\nSuccessfully added {len(resp['ids'])} listings.")
+
+    def import_items(self):
+        """
+        Lists every item in a JSON lines file, one request per 100.
+        """
+        if not self.is_logged_in:
+            print("\nYou must be logged in to sell an item.")
+        else:
+            path = input("\nFile of items, one JSON object per line: ")
+            for batch in read_batches(path, 100):
+                self.sell_items(batch)
+
     def remove_item(self):
         """
         Asks user for a list of item ids to remove from the 
@@ -217,6 +260,7 @@ class SellerClient:
 
             req = {
                 'route': 'remove_item',
+                'token': self.token,
                 'data': {
                     'ids': ids
                 }
@@ -237,7 +281,8 @@ class SellerClient:
         """
         data = {
             'route': 'list_items',
-            'data': {'username': self.username}
+            'token': self.token,
+            'data': {}
         }
 
         start = time.time()
@@ -247,7 +292,9 @@ class SellerClient:
         if not self.debug:
             self.benchmarker.log_response_time(end-start)
 
-        if not resp['items']:
+        if 'Error' in resp['status']:
+            print("\n", resp['status'])
+        elif not resp['items']:
             print("\nYou have no items for sale.")
         else:
             print("\nYou have the following items listed for sale:")
@@ -287,8 +334,10 @@ class SellerClient:
             time.sleep(0.5)
             self.login()
             time.sleep(0.5)
-            for _ in range(600):
-                self.sell_item()
+            # 600 listings, 100 per request
+            items = [self._random_item() for _ in range(600)]
+            for start in range(0, len(items), 100):
+                self.sell_items(items[start:start + 100])
                 time.sleep(0.5)
             for _ in range(300):
                 self.remove_item()
@@ -1,11 +1,26 @@
+import sys
+import multiprocessing
 import socket
 from utils import TCPHandler
+from server_runtime import run_server
+from codec import COMPACT_FIRST
+from session import SessionManager
+from sharding import ProductShards
 
 class SellerServer:
 
     def __init__(self):
-        self.handler = TCPHandler()
-        self.n_requests = 0
+        # Downstream calls to the databases ask for a compact codec
+        self.handler = TCPHandler(codecs=COMPACT_FIRST)
+        # Shared with any worker processes forked by serve()
+        self.n_requests = multiprocessing.Value('q', 0)
+        # Issues tokens on login and checks them without a database hop
+        self.sessions = SessionManager('seller')
+        # Sends product requests to whichever shards they concern
+        self.products = ProductShards(self.handler)
+        # Routes that need a valid session token
+        self.AUTH_ROUTES = ['sell_item', 'sell_items', 'remove_item', 'list_items',
+                            'get_seller_rating']
     
     def create_account(self, data: dict) -> dict:
         """
@@ -27,11 +42,20 @@ class SellerServer:
         return resp
 
     def login(self, data: dict) -> dict:
+        """
+        Checks the password with the customer database and, if it's
+        right, returns a session token for the other routes.
+        """
+        data['type'] = 'seller'
         # Make a call to the customer database
-        return self.handler.sendrecv(dest='customer_db', data=data)
+        resp = self.handler.sendrecv(dest='customer_db', data=data)
+        if 'Success' in resp['status']:
+            resp['token'] = self.sessions.issue(data['username'])
+        return resp
 
     def get_seller_rating(self, data: dict) -> dict:
-        db_resp = self.handler.sendrecv(dest='customer_db', data=data)
+        db_req = {'route': 'get_seller_rating', 'username': data['user']}
+        db_resp = self.handler.sendrecv(dest='customer_db', data=db_req)
         pos, neg = db_resp['user']['feedback']['pos'], db_resp['user']['feedback']['neg']
         resp = {
             'status': db_resp['status'],
@@ -46,16 +70,38 @@ class SellerServer:
         ID to the list of items for sale by this user. Returns
         the IDs of the items added.
         """
-        return self.handler.sendrecv('product_db', data)
+        item = data['data']
+        item['seller'] = data['user']
+        return self.products.request({'route': 'sell_item', 'data': item}, data['user'])
+
+    def sell_items(self, data: dict) -> dict:
+        """
+        Lists many items in one request, all as the logged in seller.
+        Returns the IDs of each listing's items, in the order given.
+        """
+        items = [{**item, 'seller': data['user']} for item in data['data']['items']]
+        return self.products.request({'route': 'sell_items', 'data': {'items': items}},
+                                     data['user'])
 
     def remove_item(self, data: dict) -> dict:
-        return self.handler.sendrecv('product_db', data)
+        """
+        Removes items, but only ones the logged in seller listed.
+        """
+        db_req = {
+            'route': 'remove_item',
+            'data': {'ids': data['data']['ids'], 'seller': data['user']}
+        }
+        return self.products.request(db_req, data['user'])
 
     def list_items(self, data: dict) -> dict:
-        return self.handler.sendrecv('product_db', data)
+        db_req = {
+            'route': 'list_items',
+            'data': {**data.get('data', {}), 'username': data['user']}
+        }
+        return self.products.request(db_req, data['user'])
 
     def get_request_count(self, data: dict) -> dict:
-        return {'requests': self.n_requests}
+        return {'requests': self.n_requests.value}
 
     def _route_request(self, route: str):
         """
@@ -70,31 +116,42 @@ class SellerServer:
         else:
             return None
 
-    def serve(self):
+    def _handle_request(self, data: dict) -> dict:
+        """
+        Figures out what function was called from the header
+        and calls it.
+        """
+        with self.n_requests.get_lock():
+            self.n_requests.value += 1
+        if data['route'] in self.AUTH_ROUTES:
+            username = self.sessions.validate(data.get('token'))
+            if username is None:
+                return {'status': 'Error: Not logged in.'}
+            # The token says who the user is, not the request
+            data['user'] = username
+        route = self._route_request(data['route'])
+        return route(data)
+
+    def serve(self, mode: str = 'asyncio', workers: int = None,
+              backlog: int = 128):
+        """
+        :param mode: 'asyncio', 'serial', 'thread' or 'process'. See
+                     server_runtime.run_server.
+        :param workers: Number of threads or processes for the mode.
+        :param backlog: Connections the OS will queue before we accept them.
+        """
         # Get a listening socket from the TCPHandler
-        seller_socket = self.handler.get_listener('seller_server')
+        seller_socket = self.handler.get_listener('seller_server', backlog)
         print("Seller server waiting for incoming connections.\n")
 
-        # Main accept() loop
-        while True:
-            # Accept a new request from a client
-            new_sock, client_addr = seller_socket.accept()
-            print(f"Accepted connection from {client_addr}.\n")
-            self.n_requests += 1
-            data = self.handler.recv(new_sock)
-
-            # Figure out what function was called from the header and call it
-            route = self._route_request(data['route'])
-            response = route(data)
-
-            # Send the response and check for errors in doing so
-            self.handler.send(new_sock, response)
-
-            # No longer need that connection
-            new_sock.close()
-            print(f"Disconnected from {client_addr}.\n")
+        # Main loop. Connections are kept open between requests.
+        run_server(self.handler, seller_socket, self._handle_request, mode, workers)
 
 
 if __name__ == "__main__":
     server = SellerServer()
-    server.serve()
\ No newline at end of file
+    # python <server>.py [mode] [workers] [backlog]
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'asyncio'
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    backlog = int(sys.argv[3]) if len(sys.argv) > 3 else 128
+    server.serve(mode, workers, backlog)
\ No newline at end of file
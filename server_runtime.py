@@ -0,0 +1,170 @@
+import os
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import codec
+from utils import TCPHandler
+
+
+class AsyncServer:
+    """
+    asyncio runtime shared by the databases and the frontend servers.
+    Every connection is served by its own task, so a slow client no
+    longer holds up everyone else. Requests are still dispatched by
+    the service's own _handle_request.
+    """
+
+    def __init__(self, handler: TCPHandler, handle_request, workers: int = 0):
+        """
+        :param handler: The service's TCPHandler. Supplies the framing
+                        and codecs.
+        :param handle_request: Takes a request dict and returns the
+                               response dict, or a coroutine that
+                               does.
+        :param workers: If nonzero, requests are handled on a pool of
+                        this many threads instead of on the event loop.
+                        The frontends need this because their handlers
+                        wait on the databases, and each waiting request
+                        only ties up a thread, not the loop. The databases
+                        leave it at 0 so their state is only ever touched
+                        from the loop.
+        """
+        self.handler = handler
+        self.handle_request = handle_request
+        self.executor = ThreadPoolExecutor(workers) if workers else None
+        # Largest delimited message we'll buffer
+        self.STREAM_LIMIT = 2**26
+
+        if workers:
+            # Keep enough idle connections for every worker
+            self.handler.MAX_IDLE_CONNS = max(self.handler.MAX_IDLE_CONNS, workers)
+
+    def run(self, listener) -> None:
+        """
+        Serves connections on the listening socket forever.
+        """
+        asyncio.run(self.serve(listener))
+
+    async def serve(self, listener) -> None:
+        server = await asyncio.start_server(self._serve_conn, sock=listener,
+                                            limit=self.STREAM_LIMIT)
+        async with server:
+            await server.serve_forever()
+
+    async def _read_message(self, reader: asyncio.StreamReader):
+        """
+        Async counterpart of TCPHandler.recv.
+
+        :returns: The decoded message, or None if the peer closed
+                  the connection before sending another one.
+        """
+        try:
+            header = await reader.readexactly(self.handler.FRAME_HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            return None
+
+        c = codec.BY_MARKER.get(header[0])
+        if c is None:
+            rest = await reader.readuntil(self.handler.DELIMITER)
+            return codec.CODECS['json'].decode(header + rest[:-len(self.handler.DELIMITER)])
+
+        _, length = self.handler.FRAME_HEADER.unpack(header)
+        return c.decode(await reader.readexactly(length))
+
+    def _respond(self, data: dict, codec_name: str) -> bytes:
+        return self.handler.encode(self.handle_request(data), codec_name)
+
+    async def _respond_async(self, data: dict, codec_name: str) -> bytes:
+        resp = self.handle_request(data)
+        if asyncio.iscoroutine(resp):
+            # The handler waits on something off the loop (e.g. a
+            # worker pool). Other connections are served meanwhile.
+            resp = await resp
+        return self.handler.encode(resp, codec_name)
+
+    async def _serve_conn(self, reader: asyncio.StreamReader,
+                          writer: asyncio.StreamWriter) -> None:
+        """
+        Answers requests on one connection until the peer closes it.
+        """
+        loop = asyncio.get_running_loop()
+        client_addr = writer.get_extra_info('peername')
+        print(f"Accepted connection from {client_addr}.")
+        codec_name = 'json'
+
+        try:
+            while True:
+                data = await self._read_message(reader)
+                if data is None:
+                    break
+
+                if type(data) is dict and data.get('route') == self.handler.NEGOTIATE_ROUTE:
+                    # The reply itself still goes out as JSON
+                    chosen = self.handler.pick_codec(data)
+                    frame = self.handler.encode({'status': 'Success', 'codec': chosen})
+                    codec_name = chosen
+                elif self.executor:
+                    frame = await loop.run_in_executor(self.executor, self._respond,
+                                                       data, codec_name)
+                else:
+                    frame = await self._respond_async(data, codec_name)
+
+                writer.write(frame)
+                await writer.drain()
+        except (OSError, EOFError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+            print(f"Disconnected from {client_addr}.")
+
+
+# Worker count used by each mode when none is given
+DEFAULT_WORKERS = {
+    'serial': 1,
+    'asyncio': 256,
+    'thread': 32,
+    'process': os.cpu_count() or 1
+}
+
+
+def run_server(handler: TCPHandler, listener, handle_request,
+               mode: str = 'asyncio', workers: int = None) -> None:
+    """
+    Serves requests on listener forever with the chosen concurrency
+    model. Used by the frontend servers, whose handlers keep no state
+    that workers would need to share.
+
+    :param mode: 'serial' answers one request at a time. 'asyncio' runs
+                 an AsyncServer with a pool of workers threads. 'thread'
+                 answers requests on a pool of workers threads. 'process'
+                 forks workers processes that all accept connections from
+                 the same listening socket, so CPU-bound handlers can use
+                 every core.
+    :param workers: Threads or processes, depending on the mode.
+    """
+    if mode not in DEFAULT_WORKERS:
+        raise ValueError("invalid mode supplied.")
+    if workers is None:
+        workers = DEFAULT_WORKERS[mode]
+
+    if mode == 'serial':
+        handler.serve_forever(listener, handle_request)
+    elif mode == 'asyncio':
+        AsyncServer(handler, handle_request, workers).run(listener)
+    elif mode == 'thread':
+        handler.MAX_IDLE_CONNS = max(handler.MAX_IDLE_CONNS, workers)
+        handler.serve_forever(listener, handle_request, ThreadPoolExecutor(workers))
+    else:
+        # The children inherit the listening socket and the handler.
+        # The handler drops any pooled connections it got from us.
+        ctx = multiprocessing.get_context('fork')
+        procs = [ctx.Process(target=handler.serve_forever,
+                             args=(listener, handle_request))
+                 for _ in range(workers)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
@@ -0,0 +1,85 @@
+import os
+import json
+import time
+import hmac
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class SessionManager:
+    """
+    Issues and checks the session tokens the frontend servers hand
+    out on login. A token holds the account type, the username and
+    an expiry time, signed with HMAC-SHA256, so any frontend with the
+    same secret can check it on its own without asking customer_db.
+
+    Tokens that have already been checked are kept in an LRU cache,
+    so most requests skip the signature check too.
+    """
+
+    def __init__(self, kind: str, secret: str = None, ttl: float = 3600,
+                 max_cached: int = 10000):
+        """
+        :param kind: 'seller' or 'buyer'. Tokens for the other kind
+                     are rejected.
+        :param secret: Signing key. Defaults to the SESSION_SECRET
+                       environment variable, or else a random key, in
+                       which case only this process (and any workers
+                       it forks) accepts its tokens.
+        :param ttl: Seconds a token stays valid after login.
+        :param max_cached: Most tokens to keep in the cache.
+        """
+        self.kind = kind
+        secret = secret or os.environ.get('SESSION_SECRET')
+        self.secret = secret.encode('utf-8') if secret else os.urandom(32)
+        self.ttl = ttl
+        self.max_cached = max_cached
+
+        # Token -> (username, expiry), least recently used first
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _sign(self, payload: bytes) -> str:
+        return hmac.new(self.secret, payload, hashlib.sha256).hexdigest()
+
+    def issue(self, username: str) -> str:
+        """
+        :returns: A new token for the user.
+        """
+        payload = json.dumps([self.kind, username, int(time.time() + self.ttl)]).encode('utf-8')
+        return base64.urlsafe_b64encode(payload).decode('ascii') + '.' + self._sign(payload)
+
+    def validate(self, token: str) -> str:
+        """
+        :returns: The username the token was issued to, or None if the
+                  token is missing, forged, expired or for the other
+                  kind of account.
+        """
+        now = time.time()
+        with self._lock:
+            hit = self._cache.get(token)
+            if hit is not None:
+                if hit[1] > now:
+                    self._cache.move_to_end(token)
+                    return hit[0]
+                del self._cache[token]
+                return None
+
+        try:
+            encoded, signature = token.rsplit('.', 1)
+            payload = base64.urlsafe_b64decode(encoded)
+            if not hmac.compare_digest(signature, self._sign(payload)):
+                return None
+            kind, username, expiry = json.loads(payload)
+        except (AttributeError, TypeError, ValueError):
+            return None
+        if kind != self.kind or expiry <= now:
+            return None
+
+        with self._lock:
+            self._cache[token] = (username, expiry)
+            if len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+        return username
@@ -0,0 +1,316 @@
+import os
+import zlib
+import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Ids each shard can hand out. Shard k's ids are k * ID_BLOCK + 1
+# through (k + 1) * ID_BLOCK, so the owner of any id is arithmetic
+# and a listing's ids are still consecutive.
+ID_BLOCK = 10**9
+# Shards after the first listen on SHARD_PORT + k. Shard 0 is
+# 'product_db' at its usual address.
+SHARD_PORT = 65440
+# Replica j of shard k listens on REPLICA_PORT + MAX_REPLICAS * k + j
+REPLICA_PORT = 65460
+MAX_REPLICAS = 8
+# Routes a read-only replica answers. Everything else goes to the primary.
+READ_ROUTES = ['get_item', 'get_items', 'list_items', 'get_purchase_history',
+               'search', 'query']
+
+
+def shard_name(shard: int) -> str:
+    return 'product_db' if shard == 0 else f'product_db_{shard}'
+
+
+def replica_name(shard: int, replica: int) -> str:
+    return f'{shard_name(shard)}_replica_{replica}'
+
+
+def add_shard_addresses(handler, n_shards: int, n_replicas: int = 0) -> None:
+    """
+    Adds the shards, and each one's replicas, to a TCPHandler's
+    address book.
+    """
+    for shard in range(n_shards):
+        if shard > 0:
+            handler.address_book.setdefault(
+                shard_name(shard), {'host': 'localhost', 'port': SHARD_PORT + shard})
+        for replica in range(n_replicas):
+            handler.address_book.setdefault(
+                replica_name(shard, replica),
+                {'host': 'localhost', 'port': REPLICA_PORT + MAX_REPLICAS * shard + replica})
+
+
+class ProductShards:
+    """
+    The frontends' view of the product database when it's split
+    across several processes. Each seller's items live on the shard
+    their username hashes to, and each id belongs to the shard whose
+    block it's in. Requests about one seller or one id go to one
+    shard, requests about several ids go to the shards holding them,
+    and searches go to every shard at once, with the results merged
+    in id order.
+
+    If shards have read-only replicas, reads go to one of the shard's
+    replicas at random and writes go to its primary. A frontend can
+    also keep its own copy of each shard (views), which reads go to
+    before any replica. With
+    read_your_writes, a user's reads are never answered by a replica
+    that hasn't got that user's latest write yet. The primary answers
+    them instead.
+
+    request() takes and returns the same dictionaries as a single
+    ProductDB, plus 'versions', the version of every shard that
+    answered.
+    """
+
+    def __init__(self, handler, n_shards: int = None, n_replicas: int = None,
+                 read_your_writes: bool = None):
+        """
+        :param handler: TCPHandler to send requests with.
+        :param n_shards: Defaults to the PRODUCT_SHARDS environment
+                         variable, or 1.
+        :param n_replicas: Replicas of each shard. Defaults to the
+                           PRODUCT_REPLICAS environment variable, or 0.
+        :param read_your_writes: Defaults to True unless the
+                                 READ_YOUR_WRITES environment variable
+                                 is 0.
+        """
+        self.handler = handler
+        self.n_shards = n_shards or int(os.environ.get('PRODUCT_SHARDS', 1))
+        if n_replicas is None:
+            n_replicas = int(os.environ.get('PRODUCT_REPLICAS', 0))
+        if read_your_writes is None:
+            read_your_writes = os.environ.get('READ_YOUR_WRITES', '1') != '0'
+        self.read_your_writes = read_your_writes
+        # Shard name -> a ProductDB in replica mode kept in this
+        # process, which reads are tried on first. Added by the frontend.
+        self.views = {}
+        # Seconds a local copy may go without hearing from its primary
+        # and still answer reads
+        self.max_staleness = 1.0
+        self.names = [shard_name(shard) for shard in range(self.n_shards)]
+        self.replicas = {shard_name(shard): [replica_name(shard, r) for r in range(n_replicas)]
+                         for shard in range(self.n_shards)}
+        add_shard_addresses(handler, self.n_shards, n_replicas)
+
+        # Username -> shard -> version of the user's latest write there,
+        # least recently written first
+        self._written = OrderedDict()
+        self._written_lock = threading.Lock()
+        self.MAX_WRITERS = 10000
+        # How many reads each kind of copy answered
+        self.reads = {'local': 0, 'replica': 0, 'primary': 0}
+        self._reads_lock = threading.Lock()
+        # Sends a request to every shard at once
+        self.executor = ThreadPoolExecutor(16 * self.n_shards) if self.n_shards > 1 else None
+
+    def for_seller(self, seller: str) -> str:
+        """
+        The shard a seller's items are listed on.
+        """
+        return self.names[zlib.crc32(seller.encode('utf-8')) % self.n_shards]
+
+    def for_id(self, _id) -> str:
+        """
+        The shard holding an id. Ids that can't exist go to the
+        first shard, which reports them as not found.
+        """
+        shard = (_id - 1) // ID_BLOCK if type(_id) is int else 0
+        return self.names[shard] if 0 <= shard < self.n_shards else self.names[0]
+
+    def _send(self, shard: str, db_req: dict, user: str = None) -> dict:
+        """
+        Sends a request to one shard. Reads are answered by the local
+        copy of the shard if there is one, or else by a replica if
+        there are any. Otherwise, or if those are behind or down, the
+        primary answers.
+
+        :param user: Who the request is for, if anyone. Their writes
+                     are remembered for read_your_writes.
+        """
+        view, replicas = self.views.get(shard), self.replicas[shard]
+        if (view is not None or replicas) and db_req['route'] in READ_ROUTES:
+            if user is not None and self.read_your_writes:
+                with self._written_lock:
+                    written = self._written.get(user, {}).get(shard)
+                if written is not None:
+                    db_req = {**db_req, 'min_version': written}
+
+            resp, source = {'behind': True}, None
+            if view is not None:
+                view.follow()
+                # The copy rewrites the ids in the request it's given
+                resp = view._handle_request({**db_req, 'data': dict(db_req.get('data', {})),
+                                             'max_staleness': self.max_staleness})
+                source = 'local'
+            if resp.get('behind') and replicas:
+                try:
+                    resp = self.handler.sendrecv(random.choice(replicas), db_req)
+                    source = 'replica'
+                except (ConnectionError, OSError):
+                    pass
+            if not resp.get('behind'):
+                self._count(source)
+                resp['versions'] = {shard: resp.pop('version', None)}
+                return resp
+
+        resp = self.handler.sendrecv(shard, db_req)
+        version = resp.pop('version', None)
+        if db_req['route'] in READ_ROUTES:
+            self._count('primary')
+        elif user is not None and version is not None:
+            self._note_write(user, shard, version)
+        resp['versions'] = {shard: version}
+        return resp
+
+    def _count(self, source: str) -> None:
+        with self._reads_lock:
+            self.reads[source] += 1
+
+    def stats(self) -> dict:
+        """
+        Reads answered by local copies, replicas and primaries, and
+        each local copy's version.
+        """
+        with self._reads_lock:
+            stats = {'reads': dict(self.reads)}
+        stats['views'] = {shard: view.version if view.synced else None
+                          for shard, view in self.views.items()}
+        return stats
+
+    def _note_write(self, user: str, shard: str, version: int) -> None:
+        with self._written_lock:
+            written = self._written.setdefault(user, {})
+            written[shard] = max(version, written.get(shard, version))
+            self._written.move_to_end(user)
+            if len(self._written) > self.MAX_WRITERS:
+                self._written.popitem(last=False)
+
+    def _scatter(self, requests: dict, user: str = None) -> dict:
+        """
+        Sends each shard its request in parallel.
+
+        :param requests: Shard name -> request.
+        :returns: Shard name -> response, in shard order.
+        """
+        if len(requests) == 1:
+            (shard, db_req), = requests.items()
+            return {shard: self._send(shard, db_req, user)}
+        futures = {shard: self.executor.submit(self._send, shard, db_req, user)
+                   for shard, db_req in requests.items()}
+        return {shard: futures[shard].result() for shard in self.names if shard in futures}
+
+    def _split(self, db_req: dict) -> dict:
+        """
+        Splits a request about several ids into one per shard that
+        holds any of them.
+        """
+        ids = {}
+        if not db_req['data']['ids']:
+            # Let a shard answer as it would for any empty request
+            return {self.names[0]: db_req}
+        for _id in db_req['data']['ids']:
+            ids.setdefault(self.for_id(_id), []).append(_id)
+        return {shard: {**db_req, 'data': {**db_req['data'], 'ids': shard_ids}}
+                for shard, shard_ids in ids.items()}
+
+    def _merge(self, resps: dict) -> dict:
+        """
+        Combines the shards' responses: the first error if any shard
+        failed, with every list concatenated in shard (and so id)
+        order and every shard's version.
+        """
+        merged = {'versions': {}}
+        for resp in resps.values():
+            status = resp.get('status', 'Success')
+            if 'status' not in merged or ('Error' in status and 'Error' not in merged['status']):
+                merged['status'] = status
+            for key, value in resp.items():
+                if key == 'status':
+                    continue
+                if key == 'versions':
+                    merged['versions'].update(value)
+                elif isinstance(value, list):
+                    merged.setdefault(key, []).extend(value)
+                elif key not in merged:
+                    merged[key] = value
+        return merged
+
+    def request(self, db_req: dict, user: str = None) -> dict:
+        """
+        Sends a product database request to the shards it concerns.
+
+        :param user: The logged in user the request is for, if any.
+        """
+        route, data = db_req['route'], db_req.get('data', {})
+        if self.n_shards == 1:
+            return self._send(self.names[0], db_req, user)
+
+        if route == 'sell_item':
+            return self._send(self.for_seller(data['seller']), db_req, user)
+        if route == 'sell_items':
+            return self._sell_items(db_req, user)
+        if route == 'list_items':
+            return self._send(self.for_seller(data['username']), db_req, user)
+        if route == 'get_item':
+            return self._send(self.for_id(data['id']), db_req, user)
+        if route == 'prepare_purchase':
+            return self._prepare_purchase(db_req)
+        if route in ('commit_purchase', 'abort_purchase'):
+            shards = data.get('shards', self.names)
+            return self._merge(self._scatter({shard: db_req for shard in shards}, user))
+        if 'ids' in data:
+            return self._merge(self._scatter(self._split(db_req), user))
+        # Searches and purchase histories need every shard
+        return self._merge(self._scatter({shard: db_req for shard in self.names}, user))
+
+    def _sell_items(self, db_req: dict, user: str = None) -> dict:
+        """
+        Sends each shard the listings of the sellers it holds, and
+        puts the ids they get back in the order they were given.
+        """
+        items, positions = {}, {}
+        for i, item in enumerate(db_req['data']['items']):
+            shard = self.for_seller(item['seller'])
+            items.setdefault(shard, []).append(item)
+            positions.setdefault(shard, []).append(i)
+        if not items:
+            return self._send(self.names[0], db_req, user)
+
+        resps = self._scatter({shard: {**db_req, 'data': {**db_req['data'], 'items': shard_items}}
+                               for shard, shard_items in items.items()}, user)
+        ids = [None] * len(db_req['data']['items'])
+        for shard, resp in resps.items():
+            for i, listing_ids in zip(positions[shard], resp.pop('ids', [])):
+                ids[i] = listing_ids
+        merged = self._merge(resps)
+        # A shard that refused the whole batch listed none of its items
+        merged['ids'] = [listing_ids if listing_ids is not None else [] for listing_ids in ids]
+        return merged
+
+    def _prepare_purchase(self, db_req: dict) -> dict:
+        """
+        Prepares a checkout on every shard holding one of its items.
+        If any of them refuses, the others are aborted. Otherwise the
+        shards that took part are returned under 'shards', to be sent
+        with commit_purchase or abort_purchase.
+        """
+        resps = self._scatter(self._split(db_req))
+        merged = self._merge(resps)
+        if 'Error' in merged['status']:
+            abort = {'route': 'abort_purchase', 'data': {'txn': db_req['data']['txn']}}
+            self._scatter({shard: abort for shard, resp in resps.items()
+                           if 'Error' not in resp['status']})
+            merged.pop('sellers', None)
+            return merged
+
+        sellers = {}
+        for resp in resps.values():
+            for seller, n in resp['sellers'].items():
+                sellers[seller] = sellers.get(seller, 0) + n
+        merged['sellers'] = sellers
+        merged['shards'] = list(resps)
+        return merged
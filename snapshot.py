@@ -0,0 +1,82 @@
+import pickle
+import threading
+from contextlib import contextmanager
+
+
+class Snapshots:
+    """
+    Lets any number of threads read a product store while another
+    changes it, without readers ever waiting on the writer. Two copies
+    of the store are kept (a "left-right" scheme):
+
+    - Readers pin whichever copy is published and read it for the
+      whole request, so they always see one consistent version.
+    - Writers change the other copy, then publish it by swapping one
+      reference. The old copy gets the same changes later, once the
+      readers still pinned to it have finished, so a long search
+      never delays the write it overlaps with.
+
+    Costs twice the memory and twice the work per write. Only engines
+    that live on the heap can be copied, so not the mmap engine.
+    """
+
+    def __init__(self, store):
+        """
+        :param store: The store to start from. It becomes one of the
+                      two copies, so it mustn't be changed directly
+                      afterwards.
+        """
+        self._copies = [store, pickle.loads(pickle.dumps(store, pickle.HIGHEST_PROTOCOL))]
+        self._published = 0
+        # Readers pinned to each copy, and changes the hidden copy is missing
+        self._readers = [0, 0]
+        self._pending = []
+        # Guards the reader counts. Only held to count, never while reading.
+        self._readers_changed = threading.Condition(threading.Lock())
+        # One writer at a time
+        self._write_lock = threading.Lock()
+
+    def latest(self):
+        """
+        The published copy. Only safe to use without read() when
+        nothing can write at the same time.
+        """
+        return self._copies[self._published]
+
+    @contextmanager
+    def read(self):
+        """
+        Pins the published copy for as long as the block runs.
+        """
+        with self._readers_changed:
+            side = self._published
+            self._readers[side] += 1
+        try:
+            yield self._copies[side]
+        finally:
+            with self._readers_changed:
+                self._readers[side] -= 1
+                if not self._readers[side]:
+                    self._readers_changed.notify_all()
+
+    def write(self, op: str, *args):
+        """
+        Calls a store method that changes it, and publishes the result.
+
+        :returns: What the method returned.
+        """
+        with self._write_lock:
+            hidden = 1 - self._published
+            with self._readers_changed:
+                # Readers that pinned this copy before the last publish
+                while self._readers[hidden]:
+                    self._readers_changed.wait()
+            store = self._copies[hidden]
+            for pending_op, pending_args in self._pending:
+                getattr(store, pending_op)(*pending_args)
+
+            result = getattr(store, op)(*args)
+            with self._readers_changed:
+                self._published = hidden
+            self._pending = [(op, args)]
+        return result
@@ -1,20 +1,50 @@
+import os
 import socket
-import json
+import struct
+import selectors
+import threading
+import queue
+import weakref
 import numpy as np
 import random
 import string
 
+import codec
+
 class TCPHandler:
     """
     Defines an application-layer protocol for sending and
     receiving data over TCP. 
     """
 
-    def __init__(self):
+    def __init__(self, framing: str = 'length', codecs: list = None):
+        """
+        :param framing: 'length' prefixes every message with a fixed-size
+                        header holding its length. 'delimiter' ends every
+                        message with DELIMITER instead, which is how older
+                        peers talk. recv understands both either way.
+        :param codecs: Codecs to ask for, most preferred first, when this
+                       handler opens a connection. The peer picks the first
+                       one it also speaks. Defaults to JSON only. Only
+                       length-prefixed connections can use other codecs.
+        """
+        if framing not in ['length', 'delimiter']:
+            raise ValueError("invalid framing supplied.")
+        self.framing = framing
+        self.codecs = [c for c in (codecs or ['json']) if c in codec.CODECS]
+        # Codec agreed on for each open connection. JSON if not listed.
+        self._sock_codecs = weakref.WeakKeyDictionary()
+        self.NEGOTIATE_ROUTE = '_negotiate'
+
         # Size of TCP packets in bytes
         self.MSGLEN = 4096
         # Marks end of message
         self.DELIMITER = b'###DELIMITER###\0'
+        # Header of a length-prefixed message: marker byte + payload length.
+        # The marker says which codec the payload uses. JSON always starts
+        # with '{', so no marker can be mistaken for the start of a
+        # delimited message.
+        self.FRAME_HEADER = struct.Struct('!BI')
 
         # Hostname and port no. of the frontend seller server
         self.address_book = {
@@ -24,15 +54,22 @@ class TCPHandler:
             'product_db': {'host': 'localhost', 'port': 65430}
         }
 
+        # Idle keep-alive connections, keyed by destination
+        self.MAX_IDLE_CONNS = 8
+        self._pool = {}
+        self._pool_lock = threading.Lock()
+        self._pool_pid = os.getpid()
+
     def get_conn(self, dest: str) -> socket.socket:
         """
         Used by clients to connect to the seller server or 
         the buyer server.
 
-        :param dest: One of 'seller', 'buyer', 'customer_db', or 'product_db'.
+        :param dest: One of 'seller', 'buyer', 'customer_db', or 'product_db',
+                     or any other server added to the address book.
         returns: A socket connected to the destination.
         """
-        if dest not in ['seller_server', 'buyer_sever', 'customer_db', 'product_db']:
+        if dest not in self.address_book:
             raise ValueError("invalid destination supplied.")
         
         new_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -40,79 +77,332 @@ class TCPHandler:
                           self.address_book[dest]['port']))
         return new_sock
 
-    def get_listener(self, host: str) -> socket.socket:
+    def get_listener(self, host: str, backlog: int = 128) -> socket.socket:
         """
         Returns an appropriate listening socket for the server
         specified as host.
 
         :param host: The server that needs the listening port. One of
                      'customer_db', 'seller_server', 'buyer_server',
-                     'products_db'.
+                     'products_db', or any other server added to the
+                     address book.
+        :param backlog: How many connections the OS will queue up before
+                        the server accepts them. Connections past that
+                        are refused, so keep this above the burst size.
         returns: A socket listening to the appropriate port.
         """
-        if host not in ['customer_db', 'seller_server',
-                        'buyer_server', 'product_db']:
+        if host not in self.address_book:
             raise ValueError("invalid host supplied")
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Don't wait out TIME_WAIT when a server is restarted
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind((self.address_book[host]['host'],
                    self.address_book[host]['port']))
-        sock.listen(5)
+        sock.listen(backlog)
         return sock
 
-    def send(self, sock: socket.socket, data: dict) -> None:
+    def encode(self, data: dict, codec_name: str = 'json') -> bytes:
         """
-        UTF-8 byte encodes JSON from the passed dictionary and
-        sends it over the TCP socket.
+        Encodes the passed dictionary with the given codec and
+        frames it for the wire.
         """
-        # UTF-8 byte-encode the data as JSON
-        msg = bytes(json.dumps(data), 'utf-8') + self.DELIMITER
+        if self.framing == 'length':
+            c = codec.CODECS[codec_name]
+            payload = c.encode(data)
+            return self.FRAME_HEADER.pack(c.marker, len(payload)) + payload
+        else:
+            # Binary payloads could contain the delimiter, so only JSON
+            return codec.CODECS['json'].encode(data) + self.DELIMITER
 
+    def send(self, sock: socket.socket, data: dict) -> None:
+        """
+        Encodes the passed dictionary with the codec agreed on for
+        this connection and sends it over the TCP socket.
+        """
         # Send until the data is all out
-        sock.sendall(msg)
+        sock.sendall(self.encode(data, self._sock_codecs.get(sock, 'json')))
+
+    def _recv_exact(self, sock: socket.socket, view: memoryview) -> int:
+        """
+        Fills view from the socket.
+
+        :returns: The number of bytes read. Less than len(view) only
+                  if the peer closed the connection.
+        """
+        n_read = 0
+        while n_read < len(view):
+            n = sock.recv_into(view[n_read:])
+            if n == 0:
+                break
+            n_read += n
+        return n_read
 
     def recv(self, sock: socket.socket) -> dict:
         """
-        Handles receiving bytes over TCP. Messages will always
-        be UTF-8 encoded JSON. 
+        Handles receiving bytes over TCP. Length-prefixed messages
+        are read straight into one buffer of the right size. Anything
+        else is treated as a delimited JSON message. Codec negotiation
+        requests are answered here and never returned.
+
+        :returns: The decoded message, or None if the peer closed
+                  the connection before sending another one.
         """
-        chunks = []
         while True:
+            data = self._recv_message(sock)
+            if type(data) is dict and data.get('route') == self.NEGOTIATE_ROUTE:
+                self._choose_codec(sock, data)
+            else:
+                return data
+
+    def _recv_message(self, sock: socket.socket):
+        header = bytearray(self.FRAME_HEADER.size)
+        n_read = self._recv_exact(sock, memoryview(header))
+        if n_read == 0:
+            return None
+        if n_read < len(header):
+            raise ConnectionError("connection closed mid-message.")
+
+        c = codec.BY_MARKER.get(header[0])
+        if c is None:
+            return codec.CODECS['json'].decode(self._recv_delimited(sock, header))
+
+        _, length = self.FRAME_HEADER.unpack(header)
+        payload = bytearray(length)
+        if self._recv_exact(sock, memoryview(payload)) < length:
+            raise ConnectionError("connection closed mid-message.")
+        return c.decode(payload)
+
+    def pick_codec(self, data: dict) -> str:
+        """
+        Server side of codec negotiation. Picks the first codec the
+        peer asked for that this process also speaks.
+        """
+        for name in data.get('codecs', []):
+            if name in codec.CODECS:
+                return name
+        return 'json'
+
+    def _choose_codec(self, sock: socket.socket, data: dict) -> None:
+        chosen = self.pick_codec(data)
+        # The reply itself still goes out as JSON
+        self.send(sock, {'status': 'Success', 'codec': chosen})
+        self._sock_codecs[sock] = chosen
+
+    def _negotiate(self, sock: socket.socket) -> None:
+        """
+        Client side of codec negotiation, run once on every new
+        connection when something other than JSON is preferred.
+        """
+        if self.framing != 'length' or self.codecs in ([], ['json']):
+            return
+
+        self.send(sock, {'route': self.NEGOTIATE_ROUTE, 'codecs': self.codecs})
+        resp = self.recv(sock)
+        if resp is None:
+            raise ConnectionError("connection closed by peer.")
+
+        # Peers that don't know about negotiation answer with an error
+        chosen = resp.get('codec', 'json')
+        if chosen in codec.CODECS:
+            self._sock_codecs[sock] = chosen
+
+    def _recv_delimited(self, sock: socket.socket, msg: bytearray) -> bytearray:
+        """
+        Reads the rest of a delimited message whose first bytes are
+        already in msg.
+
+        :returns: The message without its delimiter.
+        """
+        # Only the new bytes (plus enough of the old ones to catch a
+        # delimiter split across two reads) get scanned each time
+        start = 0
+        while True:
+            end = msg.find(self.DELIMITER, start)
+            if end != -1:
+                del msg[end:]
+                return msg
+            start = max(0, len(msg) - len(self.DELIMITER) + 1)
+
             # Receive some or all of a message from the socket
             chunk = sock.recv(self.MSGLEN)
-            chunks.append(chunk)
-            # Scan the message for the delimiter
-            if self.DELIMITER in chunk:
-                break
-        
-        # Put the message back together
-        msg = b''.join(chunks)
-        # Remove the delimiter
-        msg = msg[:-len(self.DELIMITER)]
-        # Return the decoded message
-        return json.loads(msg.decode('utf-8'))
+            if not chunk:
+                raise ConnectionError("connection closed mid-message.")
+            msg += chunk
+
+    def _acquire(self, dest: str) -> tuple:
+        """
+        Takes an idle connection to dest out of the pool, or opens
+        a new one if there are none.
+
+        :returns: (socket, True if the socket came from the pool)
+        """
+        with self._pool_lock:
+            if self._pool_pid != os.getpid():
+                # Sockets inherited across fork() belong to the parent
+                self._pool = {}
+                self._pool_pid = os.getpid()
+            idle = self._pool.get(dest)
+            if idle:
+                return idle.pop(), True
+
+        sock = self.get_conn(dest)
+        try:
+            self._negotiate(sock)
+        except OSError:
+            sock.close()
+            raise
+        return sock, False
+
+    def _release(self, dest: str, sock: socket.socket) -> None:
+        """
+        Returns a healthy connection to the pool so the next
+        request to dest can skip the TCP handshake.
+        """
+        with self._pool_lock:
+            idle = self._pool.setdefault(dest, [])
+            if self._pool_pid == os.getpid() and len(idle) < self.MAX_IDLE_CONNS:
+                idle.append(sock)
+                return
+
+        sock.close()
+
+    def close(self) -> None:
+        """
+        Closes every idle pooled connection.
+        """
+        with self._pool_lock:
+            for idle in self._pool.values():
+                for sock in idle:
+                    sock.close()
+            self._pool = {}
 
     def sendrecv(self, dest: str, data: dict) -> dict:
         """
-        Handles call and response over TCP.
+        Handles call and response over TCP. Connections are kept
+        alive and reused for later requests to the same destination.
 
         :param dest: The server we're sending the request to.
         :param data: The packet we're sending.
 
         :return: The response as a dictionary. Usually a status message.
         """
-        # Get a new socket for each request
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            # Connect to our destination port
-            sock.connect((self.address_book[dest]['host'],
-                          self.address_book[dest]['port']))
+        sock, reused = self._acquire(dest)
+        try:
+            self.send(sock, data)
+            resp = self.recv(sock)
+            if resp is None:
+                raise ConnectionError("connection closed by peer.")
+        except OSError:
+            sock.close()
+            if not reused:
+                raise
+            # The server may have dropped the idle connection, so
+            # try once more on a fresh one
+            sock = self.get_conn(dest)
+            try:
+                self._negotiate(sock)
+                self.send(sock, data)
+                resp = self.recv(sock)
+                if resp is None:
+                    raise ConnectionError("connection closed by peer.")
+            except OSError:
+                sock.close()
+                raise
+
+        self._release(dest, sock)
+        return resp
+
+    def _serve_one(self, sock: socket.socket, handle_request) -> bool:
+        """
+        Answers one request on a connection that's ready.
+
+        :returns: False if the connection is done and should be closed.
+        """
+        try:
+            data = self.recv(sock)
+        except OSError:
+            return False
+        if data is None:
+            return False
+
+        response = handle_request(data)
+        try:
+            self.send(sock, response)
+        except OSError:
+            return False
+        return True
+
+    def serve_forever(self, listener: socket.socket, handle_request,
+                      executor=None) -> None:
+        """
+        Main loop shared by the servers. Accepted connections stay
+        open and every request on them is answered until the peer
+        closes the connection.
+
+        :param listener: A socket from get_listener. It may be shared
+                         with other processes running this same loop.
+        :param handle_request: Takes a request dict and returns the
+                               response dict.
+        :param executor: If given, requests are answered on its threads
+                         and this loop only waits for connections to
+                         become readable. Otherwise they're answered here,
+                         one at a time.
+        """
+        sel = selectors.DefaultSelector()
+        listener.setblocking(False)
+        sel.register(listener, selectors.EVENT_READ)
+
+        if executor is not None:
+            # Workers hand connections back here once they've answered
+            # a request, and poke the selector awake to pick them up
+            done = queue.SimpleQueue()
+            wake_r, wake_w = socket.socketpair()
+            wake_r.setblocking(False)
+            sel.register(wake_r, selectors.EVENT_READ)
+
+            def serve_in_worker(sock, client_addr):
+                keep = False
+                try:
+                    keep = self._serve_one(sock, handle_request)
+                finally:
+                    if keep:
+                        done.put((sock, client_addr))
+                        wake_w.send(b'\0')
+                    else:
+                        sock.close()
+                        print(f"Disconnected from {client_addr}.")
+
+        while True:
+            for key, _ in sel.select():
+                sock = key.fileobj
 
-            # Encode the message and send it 
-            msg = bytes(json.dumps(data), 'utf-8') + self.DELIMITER
-            sock.sendall(msg)
+                # Accept a new connection from a client
+                if sock is listener:
+                    try:
+                        new_sock, client_addr = listener.accept()
+                    except BlockingIOError:
+                        # Another process sharing the listener got it first
+                        continue
+                    new_sock.setblocking(True)
+                    print(f"Accepted connection from {client_addr}.")
+                    sel.register(new_sock, selectors.EVENT_READ, client_addr)
+                    continue
 
-            # Receive the response and decode it
-            return self.recv(sock)
+                if executor is None:
+                    if not self._serve_one(sock, handle_request):
+                        sel.unregister(sock)
+                        sock.close()
+                        print(f"Disconnected from {key.data}.")
+                elif sock is wake_r:
+                    wake_r.recv(self.MSGLEN)
+                    while not done.empty():
+                        ready_sock, client_addr = done.get()
+                        sel.register(ready_sock, selectors.EVENT_READ, client_addr)
+                else:
+                    # Stop watching the connection while a worker has it
+                    sel.unregister(sock)
+                    executor.submit(serve_in_worker, sock, key.data)
 
 
 class ResponseTimeBenchmarker: